@@ -0,0 +1,114 @@
+"""Cold start: how long importing the bot takes, and what it spends the time on.
+
+    python benchmarks/bench_cold_start.py --runs 5 --budget 1.0
+
+Each run imports kronos_music_bot in a fresh interpreter under ``-X importtime``
+and reports the fastest run: the bot's own startup phases (see
+``StartupProfile``) and the slowest top-level imports. The import time gated on
+is ``-X importtime``'s cumulative figure for kronos_music_bot, so every module
+it pulls in counts, standard library included. Exits non-zero when that is
+over ``--budget`` seconds, or when a module listed in ``--forbid`` got imported
+eagerly, so it can gate CI.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+import kronos_music_bot as kronos
+kronos.startup.mark('probe')
+print(json.dumps({{'seconds': time.perf_counter() - kronos.IMPORT_STARTED, 'phases': kronos.startup.phases}}))
+"""
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+def run_once(tmp: str):
+    env = dict(os.environ,
+               KRONOS_STATE_DB=os.path.join(tmp, 'state.db'),
+               KRONOS_LOUDNESS_DB=os.path.join(tmp, 'loudness.db'),
+               KRONOS_HISTORY_DB=os.path.join(tmp, 'history.db'))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE.format(root=ROOT)],
+                          cwd=tmp, env=env, capture_output=True, text=True, check=True)
+
+    # Children are printed before their parent: the direct imports of the bot
+    # are the depth 1 lines right above the kronos_music_bot line.
+    imports, children, direct = [], [], []
+    cumulative = None
+    for line in proc.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+
+        self_us, cumulative_us, indent, name = match.groups()
+        entry = (name, int(self_us) / 1e6, int(cumulative_us) / 1e6)
+        imports.append(entry)
+
+        depth = len(indent) // 2
+        if depth == 1:
+            children.append(entry)
+        elif depth == 0:
+            if name == 'kronos_music_bot':
+                direct = children
+                cumulative = entry[2]
+            children = []
+
+    profile = json.loads(proc.stdout.splitlines()[-1])
+    profile['import_seconds'] = cumulative
+    return profile, imports, direct
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='slowest imports of the bot module to list')
+    parser.add_argument('--budget', type=float, default=1.0, help='seconds the import may take, 0 for no limit')
+    parser.add_argument('--forbid', default='youtube_dl', help='comma separated modules that must load lazily')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='kronos-bench-') as tmp:
+        runs = [run_once(tmp) for _ in range(args.runs)]
+
+    profile, imports, direct = min(runs, key=lambda run: run[0]['import_seconds'])
+    top = sorted(direct, key=lambda entry: entry[2], reverse=True)
+    loaded = {name for name, *_ in imports}
+    eager = [name for name in args.forbid.split(',') if name and name in loaded]
+
+    result = {
+        'python': sys.version.split()[0],
+        'runs': args.runs,
+        'import_seconds': round(profile['import_seconds'], 4),
+        'median_seconds': round(sorted(run[0]['import_seconds'] for run in runs)[len(runs) // 2], 4),
+        'profiled_seconds': round(profile['seconds'], 4),
+        'phases': {phase: round(elapsed, 4) for phase, elapsed in profile['phases'].items()},
+        'top_imports': [{'module': name, 'self': round(own, 4), 'cumulative': round(cumulative, 4)}
+                        for name, own, cumulative in top[:args.top]],
+        'modules': len(imports),
+        'eager': eager,
+    }
+
+    failures = []
+    if args.budget and profile['import_seconds'] > args.budget:
+        failures.append('import took {:.3f}s, budget is {:.3f}s'.format(profile['import_seconds'], args.budget))
+    if eager:
+        failures.append('imported at startup: {}'.format(', '.join(eager)))
+
+    result['ok'] = not failures
+    print(json.dumps(result, indent=2))
+
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
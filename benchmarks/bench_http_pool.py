@@ -0,0 +1,146 @@
+"""Connections opened per resolved track, with and without the keep-alive pool.
+
+    python benchmarks/bench_http_pool.py --tracks 200 --workers 4 --handshake-ms 30
+
+A local HTTP/1.1 server stands in for YouTube. It counts connections and
+requests, and it can sleep on every new connection in place of a TLS
+handshake. Each track makes the requests a play costs the extractor: the
+search page, the watch page and the player API call. The player JS is
+fetched once per player version, like youtube_dl's per-version cache.
+The same YoutubeDL opener runs these once as shipped (a new connection per
+request) and once with ``ConnectionPool`` installed.
+"""
+
+import argparse
+import concurrent.futures
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import youtube_dl  # noqa: E402
+
+import kronos_music_bot as kronos  # noqa: E402
+from fixtures import video_id  # noqa: E402
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    SIZES = {'/results': 400 * 1024, '/watch': 700 * 1024, '/youtubei': 120 * 1024, '/s/player': 1500 * 1024}
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+        if self.server.handshake:
+            time.sleep(self.server.handshake)
+
+    def respond(self):
+        self.server.count('requests')
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        size = next((size for prefix, size in self.SIZES.items() if self.path.startswith(prefix)), 1024)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        self.wfile.write(b'x' * size)
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handshake: float):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.handshake = handshake
+        self.counts = {'connections': 0, 'requests': 0}
+        self._lock = threading.Lock()
+
+    def count(self, name: str):
+        with self._lock:
+            self.counts[name] += 1
+
+    def reset(self):
+        with self._lock:
+            counts, self.counts = self.counts, {'connections': 0, 'requests': 0}
+        return counts
+
+
+def resolve(ytdl, base: str, index: int, players: set, lock: threading.Lock):
+    vid = video_id(index)
+    urls = ['{}/results?search_query=bench+track+{}'.format(base, index),
+            '{}/watch?v={}'.format(base, vid)]
+
+    with lock:
+        version = 'v{}'.format(index // 1000)
+        fetch_player = version not in players
+        players.add(version)
+    if fetch_player:
+        urls.append('{}/s/player/{}/player_ias.vflset/en_US/base.js'.format(base, version))
+
+    for url in urls:
+        ytdl.urlopen(url).read()
+
+    api = urllib.request.Request('{}/youtubei/v1/player'.format(base), data=b'{"videoId": "%s"}' % vid.encode(),
+                                 headers={'Content-Type': 'application/json'})
+    ytdl.urlopen(api).read()
+
+
+def run(ytdl, server: StandInServer, args):
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    players, lock = set(), threading.Lock()
+
+    server.reset()
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.workers) as executor:
+        list(executor.map(lambda i: resolve(ytdl, base, i, players, lock), range(args.tracks)))
+    elapsed = time.perf_counter() - started
+    counts = server.reset()
+
+    return {'seconds': round(elapsed, 3),
+            'ms_per_track': round(elapsed * 1000 / args.tracks * args.workers, 2),
+            'connections': counts['connections'], 'requests': counts['requests'],
+            'connections_per_track': round(counts['connections'] / args.tracks, 3),
+            'requests_per_track': round(counts['requests'] / args.tracks, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=4, help='extractor threads resolving at once')
+    parser.add_argument('--handshake-ms', type=float, default=30, help='server delay per new connection')
+    parser.add_argument('--per-host', type=int, default=4)
+    args = parser.parse_args()
+
+    server = StandInServer(args.handshake_ms / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # No proxies from the environment: everything goes to the stand-in.
+    options = dict(kronos.YTDLSource.YTDL_OPTIONS, proxy='')
+    fresh = youtube_dl.YoutubeDL(options, auto_init=False)
+    pooled = youtube_dl.YoutubeDL(options, auto_init=False)
+    pool = kronos.ConnectionPool(per_host=args.per_host)
+    pool.install(pooled)
+
+    results = {'tracks': args.tracks, 'workers': args.workers, 'handshake_ms': args.handshake_ms,
+               'fresh': run(fresh, server, args), 'pooled': run(pooled, server, args)}
+    results['pooled']['pool'] = pool.stats()
+
+    server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
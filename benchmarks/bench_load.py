@@ -0,0 +1,227 @@
+"""Load test of the Music cog against a fake gateway, voice client and extractor.
+
+    python benchmarks/bench_load.py --guilds 2000 --songs 5 --extract-latency 0.05
+
+Three phases, reported as one JSON document:
+
+* commands: every guild plays ``--songs`` tracks, then runs queue, shuffle,
+  remove and skip; latency percentiles per command.
+* memory: the same queues built again under tracemalloc; bytes per guild.
+* streams: increasing numbers of guilds play at once on real AudioPlayer
+  threads until frames start going out late; the highest step that kept up.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord  # noqa: E402
+import harness  # noqa: E402
+import kronos_music_bot as kronos  # noqa: E402
+from fixtures import make_audio  # noqa: E402
+
+
+def percentiles(samples: list):
+    if not samples:
+        return {'count': 0}
+
+    samples = sorted(samples)
+
+    def at(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+
+    return {'count': len(samples), 'p50_ms': at(0.5), 'p90_ms': at(0.9), 'p99_ms': at(0.99),
+            'max_ms': round(samples[-1] * 1000, 3)}
+
+
+async def fill_guild(gateway, guild, first: int, songs: int, latencies: dict = None, errors: dict = None):
+    script = ['play bench track {}'.format(first + i) for i in range(songs)]
+    if latencies is not None:
+        script += ['queue', 'shuffle', 'remove 1', 'skip']
+
+    for content in script:
+        elapsed, failed = await gateway.command(guild, content)
+        if latencies is not None:
+            name = content.split(' ', 1)[0]
+            latencies.setdefault(name, []).append(elapsed)
+            if failed:
+                errors[name] = errors.get(name, 0) + 1
+
+
+async def run_guilds(gateway, guilds: list, songs: int, concurrency: int, latencies=None, errors=None):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(i, guild):
+        async with semaphore:
+            await fill_guild(gateway, guild, i * songs, songs, latencies, errors)
+
+    await asyncio.gather(*(run(i, guild) for i, guild in enumerate(guilds)))
+
+
+async def commands_phase(gateway, args):
+    guilds = [harness.FakeGuild() for _ in range(args.guilds)]
+    latencies, errors = {}, {}
+
+    started = time.perf_counter()
+    await run_guilds(gateway, guilds, args.songs, args.concurrency, latencies, errors)
+    elapsed = time.perf_counter() - started
+
+    await gateway.reset()
+    return {
+        'seconds': round(elapsed, 2),
+        'commands_per_second': round(sum(map(len, latencies.values())) / elapsed, 1),
+        'latency': {name: dict(percentiles(samples), errors=errors.get(name, 0))
+                    for name, samples in latencies.items()},
+        'extractor_calls': gateway.ytdl.calls,
+    }
+
+
+async def memory_phase(gateway, args):
+    gc.collect()
+    tracemalloc.start()
+
+    # The fake guilds themselves aren't the bot's memory.
+    guilds = [harness.FakeGuild() for _ in range(args.guilds)]
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+
+    await run_guilds(gateway, guilds, args.songs, args.concurrency)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    grown = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    await gateway.reset()
+    return {'guilds': args.guilds, 'songs_per_guild': args.songs, 'bytes_per_guild': round(grown / args.guilds)}
+
+
+async def stream_step(gateway, count: int, window: float, concurrency: int):
+    guilds = [harness.FakeGuild(harness.LiveVoiceClient) for _ in range(count)]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def start(i, guild):
+        # Bounded like the commands phase, or the extractor pool turns most
+        # of a big step away before anything plays.
+        async with semaphore:
+            await gateway.command(guild, 'play bench stream {}'.format(i))
+
+    await asyncio.gather(*(start(i, guild) for i, guild in enumerate(guilds)))
+
+    deadline = time.perf_counter() + 30
+    while not all(guild.voice_client and guild.voice_client.is_playing() for guild in guilds):
+        if time.perf_counter() > deadline:
+            break
+        await asyncio.sleep(0.1)
+
+    for guild in guilds:
+        if guild.voice_client:
+            guild.voice_client.packets = guild.voice_client.late = 0
+
+    lag = []
+    started = time.perf_counter()
+    while time.perf_counter() - started < window:
+        tick = time.perf_counter()
+        await asyncio.sleep(0.05)
+        lag.append(max(time.perf_counter() - tick - 0.05, 0.0))
+
+    elapsed = time.perf_counter() - started
+    clients = [guild.voice_client for guild in guilds if guild.voice_client and guild.voice_client.is_playing()]
+    packets = sum(client.packets for client in clients)
+    late = sum(client.late for client in clients)
+
+    await gateway.reset()
+    return {
+        'streams': count,
+        'not_playing': count - len(clients),
+        'delivered': round(packets / (count * elapsed * 50), 3),
+        'late_ratio': round(late / packets, 4) if packets else None,
+        'loop_lag': percentiles(lag),
+    }
+
+
+async def streams_phase(gateway, args):
+    if not discord.opus.is_loaded():
+        try:
+            discord.opus._load_default()
+        except Exception:
+            pass
+    if discord.opus.is_loaded():
+        harness.LiveVoiceClient.encoder = discord.opus.Encoder()
+
+    mode = args.audio
+    if mode == 'auto':
+        mode = 'ffmpeg' if shutil.which('ffmpeg') else 'synthetic'
+
+    gateway.ytdl.duration = int(args.window) + 30
+    steps = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if mode == 'ffmpeg':
+            path = os.path.join(tmp, 'stream.webm')
+            make_audio(path, gateway.ytdl.duration)
+            gateway.ytdl.stream_url = path
+            # Local files don't understand the HTTP reconnect flags.
+            kronos.YTDLSource.FFMPEG_OPTIONS = {'before_options': '', 'options': '-vn'}
+            gateway.use_synthetic(False)
+
+        for count in map(int, args.streams.split(',')):
+            step = await stream_step(gateway, count, args.window, args.concurrency)
+            step['kept_up'] = (not step['not_playing'] and step['delivered'] >= 0.95 and step['late_ratio'] is not None
+                               and step['late_ratio'] <= args.late_threshold)
+            steps.append(step)
+            if not step['kept_up']:
+                break
+
+        gateway.use_synthetic(True)
+
+    sustained = max((step['streams'] for step in steps if step['kept_up']), default=0)
+    return {'audio': mode, 'encoder': harness.LiveVoiceClient.encoder is not None,
+            'sustained_streams': sustained, 'steps': steps}
+
+
+async def main(args):
+    gateway = harness.FakeGateway(harness.StubYoutubeDL(latency=args.extract_latency))
+    kronos.VoiceState.DEFAULT_VOLUME = args.volume
+
+    results = {
+        'benchmark': 'load',
+        'config': dict(vars(args), python=platform.python_version(), cpus=os.cpu_count(),
+                       engine=kronos.YTDLSource.ENGINE),
+    }
+
+    for phase in args.phases.split(','):
+        results[phase] = await globals()['{}_phase'.format(phase)](gateway, args)
+
+    music = gateway.cog
+    if music.persister is not None:
+        music.persister.cancel()
+    kronos.YTDLSource.pool.shutdown()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=1000)
+    parser.add_argument('--songs', type=int, default=5, help='songs queued per guild')
+    parser.add_argument('--concurrency', type=int, default=50, help='guilds sending commands at once')
+    parser.add_argument('--extract-latency', type=float, default=0.05, help='seconds per stub extract_info call')
+    parser.add_argument('--volume', type=float, default=0.5, help='1.0 lets the opus engine pass packets through')
+    parser.add_argument('--phases', default='commands,memory,streams')
+    parser.add_argument('--streams', default='25,50,100,200,400,800', help='concurrent streams to try, in order')
+    parser.add_argument('--window', type=float, default=10, help='seconds measured per stream step')
+    parser.add_argument('--audio', choices=('auto', 'ffmpeg', 'synthetic'), default='auto')
+    parser.add_argument('--late-threshold', type=float, default=0.01, help='share of late frames still kept up')
+    args = parser.parse_args()
+
+    results = kronos.bot.loop.run_until_complete(main(args))
+    print(json.dumps(results, indent=2))
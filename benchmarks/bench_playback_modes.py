@@ -0,0 +1,93 @@
+"""CPU cost per stream of each playback mode, as concurrent streams one core can sustain.
+
+    python benchmarks/bench_playback_modes.py --seconds 60
+
+Each mode plays a local Opus/WebM file through the same source classes the
+bot uses and charges both the Python process and its FFmpeg children.
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord  # noqa: E402
+import kronos_music_bot as kronos  # noqa: E402
+from fixtures import make_audio  # noqa: E402
+
+
+CTX = types.SimpleNamespace(author=object(), channel=object())
+
+
+def play(source, encoder=None):
+    # Mirrors AudioPlayer: read 20 ms frames and encode them unless they
+    # are Opus already. No real-time pacing, we only care about CPU.
+    frames = 0
+    while True:
+        data = source.read()
+        if not data:
+            break
+
+        if encoder is not None:
+            encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+
+        frames += 1
+
+    source.cleanup()
+    return frames
+
+
+def cpu_seconds():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def run_mode(song, mode: str):
+    kronos.YTDLSource.ENGINE = 'pcm' if mode == 'pcm' else 'opus'
+    volume = 1.0 if mode == 'opus-passthrough' else 0.5
+    encoder = discord.opus.Encoder() if mode == 'pcm' else None
+
+    start = cpu_seconds()
+    frames = play(kronos.YTDLSource.open(song, volume=volume), encoder)
+    used = cpu_seconds() - start
+
+    audio_seconds = frames * 0.02
+    return {
+        'mode': mode,
+        'audio_seconds': round(audio_seconds, 2),
+        'cpu_seconds': round(used, 3),
+        'streams_per_core': round(audio_seconds / used, 1) if used else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=int, default=60)
+    parser.add_argument('--modes', default='pcm,opus-volume,opus-passthrough')
+    args = parser.parse_args()
+
+    if not discord.opus.is_loaded():
+        discord.opus._load_default()
+
+    # Local files don't understand the HTTP reconnect flags.
+    kronos.YTDLSource.FFMPEG_OPTIONS = {'before_options': '', 'options': '-vn'}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'track.webm')
+        make_audio(path, args.seconds)
+
+        track = kronos.Track.placeholder(path, 'benchmark')
+        song = kronos.Song(CTX.author, CTX.channel, track, kronos.Stream(path, 'opus'))
+        results = [run_mode(song, mode) for mode in args.modes.split(',')]
+
+    print(json.dumps({'benchmark': 'playback_modes', 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
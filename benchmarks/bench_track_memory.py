@@ -0,0 +1,70 @@
+"""Per-queued-track memory: retaining the raw youtube_dl info dict vs a compact Track.
+
+    python benchmarks/bench_track_memory.py --tracks 10000
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kronos_music_bot as kronos  # noqa: E402
+from fixtures import make_info  # noqa: E402
+
+
+CTX = types.SimpleNamespace(author=object(), channel=object())
+
+
+def queue_raw_info(count: int):
+    # What every queued YTDLSource used to keep alive through ``self.data``.
+    return [make_info(i) for i in range(count)]
+
+
+def queue_songs(count: int):
+    songs = []
+    for i in range(count):
+        info = make_info(i)
+        stream = kronos.Stream(info['url'], info['acodec'])
+        songs.append(kronos.Song(CTX.author, CTX.channel, kronos.Track.from_info(info), stream))
+
+    return songs
+
+
+def bytes_per_track(build, count: int):
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    queue = build(count)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - baseline
+
+    tracemalloc.stop()
+    del queue
+    return used / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=10000)
+    args = parser.parse_args()
+
+    before = bytes_per_track(queue_raw_info, args.tracks)
+    after = bytes_per_track(queue_songs, args.tracks)
+
+    print(json.dumps({
+        'benchmark': 'track_memory',
+        'tracks': args.tracks,
+        'raw_info_bytes_per_track': round(before),
+        'song_bytes_per_track': round(after),
+        'reduction': round(before / after, 1),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
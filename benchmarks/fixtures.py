@@ -0,0 +1,97 @@
+import random
+import string
+import subprocess
+
+
+def video_id(index: int):
+    rng = random.Random(index)
+    return ''.join(rng.choice(string.ascii_letters + string.digits + '-_') for _ in range(11))
+
+
+def stream_url(vid: str, itag: int = 251, expire: int = 2000000000):
+    return ('https://rr4---sn-4g5e6nzz.googlevideo.com/videoplayback?expire={0}&ei=Xyz{1}&ip=203.0.113.7'
+            '&id=o-{1}&itag={2}&source=youtube&requiressl=yes&mime=audio%2Fwebm&gir=yes&clen=3437906'
+            '&dur=213.121&lmt=1575000000000000&fvip=4&keepalive=yes&c=WEB&sparams=expire%2Cei%2Cip%2Cid'
+            '%2Citag%2Csource%2Crequiressl%2Cmime%2Cgir%2Cclen%2Cdur%2Clmt&sig=AOq0QJ8wRQIhA{1}{1}{1}'
+            .format(expire, vid, itag))
+
+
+def make_audio(path: str, seconds: int):
+    """A stereo 48 kHz Opus/WebM sine tone, the shape of a typical YouTube audio stream."""
+
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', 'sine=frequency=440:duration={}'.format(seconds),
+                    '-ac', '2', '-ar', '48000', '-c:a', 'libopus', '-b:a', '128k', path], check=True)
+
+
+def make_info(index: int, *, duration: int = 213):
+    """A processed youtube_dl info dict shaped (and sized) like the real thing."""
+
+    vid = video_id(index)
+    formats = []
+    for itag, ext, acodec, abr in ((249, 'webm', 'opus', 50), (250, 'webm', 'opus', 70), (140, 'm4a', 'mp4a.40.2', 128),
+                                   (251, 'webm', 'opus', 160), (160, 'mp4', 'none', 0), (133, 'mp4', 'none', 0),
+                                   (278, 'webm', 'none', 0), (134, 'mp4', 'none', 0), (242, 'webm', 'none', 0),
+                                   (135, 'mp4', 'none', 0), (243, 'webm', 'none', 0), (136, 'mp4', 'none', 0),
+                                   (244, 'webm', 'none', 0), (247, 'webm', 'none', 0), (18, 'mp4', 'mp4a.40.2', 96),
+                                   (22, 'mp4', 'mp4a.40.2', 192)):
+        formats.append({
+            'format_id': str(itag),
+            'url': stream_url(vid, itag),
+            'ext': ext,
+            'acodec': acodec,
+            'vcodec': 'none' if abr else 'avc1.4d401e',
+            'abr': abr,
+            'asr': 48000 if acodec == 'opus' else 44100,
+            'filesize': 3437906 + itag,
+            'tbr': abr or 1000.0,
+            'format_note': 'tiny' if abr else '480p',
+            'container': '{}_dash'.format(ext),
+            'protocol': 'https',
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko)',
+                'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.7',
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                'Accept-Encoding': 'gzip, deflate',
+                'Accept-Language': 'en-us,en;q=0.5',
+            },
+            'format': '{} - audio only (tiny)'.format(itag),
+        })
+
+    return {
+        'id': vid,
+        'title': 'Benchmark Track {} ({})'.format(index, vid),
+        'uploader': 'Uploader {}'.format(index % 997),
+        'uploader_id': 'UC{}'.format(vid * 2)[:24],
+        'uploader_url': 'http://www.youtube.com/channel/UC{}'.format(vid * 2)[:57],
+        'channel_id': 'UC{}'.format(vid * 2)[:24],
+        'upload_date': '20191129',
+        'duration': duration,
+        'view_count': 1000000 + index,
+        'like_count': 10000 + index,
+        'dislike_count': 100 + index,
+        'average_rating': 4.9,
+        'age_limit': 0,
+        'webpage_url': 'https://www.youtube.com/watch?v={}'.format(vid),
+        'thumbnail': 'https://i.ytimg.com/vi/{}/maxresdefault.jpg'.format(vid),
+        'thumbnails': [{'url': 'https://i.ytimg.com/vi/{}/{}.jpg'.format(vid, name), 'id': str(i),
+                        'width': width, 'height': width * 9 // 16, 'resolution': '{}x{}'.format(width, width * 9 // 16)}
+                       for i, (name, width) in enumerate((('default', 120), ('mqdefault', 320), ('hqdefault', 480),
+                                                          ('sddefault', 640), ('maxresdefault', 1280)))],
+        'description': ('Official audio for benchmark track {}. '.format(index) * 40),
+        'categories': ['Music'],
+        'tags': ['benchmark', 'track {}'.format(index), 'music', 'official audio', 'lyrics', 'remix', 'live',
+                 'acoustic', 'cover', 'instrumental', 'karaoke', 'extended', 'radio edit', 'hq', vid],
+        'formats': formats,
+        'format_id': '251',
+        'url': stream_url(vid),
+        'ext': 'webm',
+        'acodec': 'opus',
+        'abr': 160,
+        'asr': 48000,
+        'extractor': 'youtube',
+        'extractor_key': 'Youtube',
+        'webpage_url_basename': 'watch',
+        'display_id': vid,
+        'fulltitle': 'Benchmark Track {} ({})'.format(index, vid),
+        'http_headers': dict(formats[3]['http_headers']),
+    }
@@ -0,0 +1,363 @@
+"""Offline stand-ins for Discord and YouTube, so the Music cog can be driven locally.
+
+Commands go through the real ``commands.Bot`` parsing, checks and hooks; only
+the edges are replaced: messages, guilds and channels are plain objects,
+voice clients either hold sources without reading them (``FakeVoiceClient``)
+or pull frames on discord.py's own ``AudioPlayer`` thread
+(``LiveVoiceClient``), and ``StubYoutubeDL`` answers from fixtures.
+"""
+
+import itertools
+import os
+import tempfile
+import threading
+import time
+import types
+import zlib
+
+# Keep the bot's databases out of the working tree and the loudness scanner
+# from spawning FFmpeg behind the benchmark's back.
+_tmp = tempfile.mkdtemp(prefix='kronos-bench-')
+os.environ.setdefault('KRONOS_STATE_DB', os.path.join(_tmp, 'state.db'))
+os.environ.setdefault('KRONOS_LOUDNESS_DB', os.path.join(_tmp, 'loudness.db'))
+os.environ.setdefault('KRONOS_HISTORY_DB', os.path.join(_tmp, 'history.db'))
+os.environ.setdefault('KRONOS_LOUDNESS', '0')
+
+import discord  # noqa: E402
+from discord.ext import commands  # noqa: E402
+from discord.player import AudioPlayer  # noqa: E402
+
+import kronos_music_bot as kronos  # noqa: E402
+from fixtures import make_info, video_id  # noqa: E402
+
+
+_ids = itertools.count(10 ** 17)
+
+
+class StubYoutubeDL:
+    """Answers ``extract_info`` from canned info dicts after ``latency`` seconds.
+
+    Searches of the form ``bench track <n>`` resolve to fixture track ``n``;
+    every stream URL points at ``stream_url`` (a local file for FFmpeg).
+    """
+
+    def __init__(self, stream_url: str = 'bench.webm', *, latency: float = 0.0, duration: int = 213):
+        self.stream_url = stream_url
+        self.latency = latency
+        self.duration = duration
+        self.calls = 0
+        self._index = {}
+
+    def extract_info(self, url: str, download: bool = False, process: bool = True):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        if url.startswith('https://www.youtube.com/watch?v='):
+            vid = url.rsplit('=', 1)[1]
+            if not process:
+                return {'id': vid, 'webpage_url': url}
+
+            info = make_info(self._index.get(vid, 0), duration=self.duration)
+            info['url'] = self.stream_url
+            return info
+
+        index = self.index_of(url)
+        vid = video_id(index)
+        self._index[vid] = index
+        return {'_type': 'playlist', 'entries': [{'id': vid, 'title': 'Benchmark Track {}'.format(index),
+                                                  'webpage_url': 'https://www.youtube.com/watch?v={}'.format(vid)}]}
+
+    @staticmethod
+    def index_of(search: str):
+        head, _, tail = search.rpartition(' ')
+        if head and tail.isdigit():
+            return int(tail)
+        return zlib.crc32(search.encode())
+
+
+class SyntheticSource(discord.AudioSource):
+    """Opus silence for the length of the song, in place of an FFmpeg process."""
+
+    SILENCE = b'\xf8\xff\xfe'
+
+    def __init__(self, song, *, volume: float = 0.5, start: float = 0, eq: str = None):
+        self.song = song
+        self.stream = song.stream
+        self.volume = volume
+        self.eq = eq
+        self.frames = int(start * 50)
+        self.limit = int(song.length * 50)
+        self.clock = kronos.FrameClock()
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        if self.frames >= self.limit:
+            return b''
+
+        self.frames += 1
+        self.clock.tick()
+        return self.SILENCE
+
+    def cleanup(self):
+        self.clock.flush()
+
+    @property
+    def position(self):
+        return self.frames * 0.02
+
+
+class _FakeWebSocket:
+    async def speak(self, speaking: bool = True):
+        pass
+
+
+class FakeVoiceClient:
+    """Accepts sources but never reads them; stopping ends the song right away."""
+
+    def __init__(self, channel: 'FakeVoiceChannel'):
+        self.channel = channel
+        self.guild = channel.guild
+        self.loop = kronos.bot.loop
+        self.ws = _FakeWebSocket()
+        self._connected = threading.Event()
+        self._connected.set()
+        self._source = None
+        self._after = None
+        self._paused = False
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, value):
+        self._source = value
+
+    def play(self, source, *, after=None):
+        if not self.is_connected():
+            raise discord.ClientException('Not connected to voice.')
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+
+        self._source = source
+        self._after = after
+        self._paused = False
+
+    def is_connected(self):
+        return self._connected.is_set()
+
+    def is_playing(self):
+        return self._source is not None and not self._paused
+
+    def is_paused(self):
+        return self._source is not None and self._paused
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def stop(self):
+        source, after = self._source, self._after
+        self._source = self._after = None
+
+        if source is not None:
+            source.cleanup()
+            if after is not None:
+                after(None)
+
+    async def move_to(self, channel: 'FakeVoiceChannel'):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self.guild.voice_client = None
+
+
+class LiveVoiceClient(FakeVoiceClient):
+    """Plays on a real ``AudioPlayer`` thread and counts frames sent late."""
+
+    encoder = None
+
+    def __init__(self, channel: 'FakeVoiceChannel'):
+        super().__init__(channel)
+        self._player = None
+        self.packets = 0
+        self.late = 0
+
+    @property
+    def source(self):
+        return self._player.source if self._player else None
+
+    @source.setter
+    def source(self, value):
+        self._player._set_source(value)
+
+    def play(self, source, *, after=None):
+        if not self.is_connected():
+            raise discord.ClientException('Not connected to voice.')
+        if self.is_playing():
+            raise discord.ClientException('Already playing audio.')
+
+        self._player = AudioPlayer(source, self, after=after)
+        self._player.start()
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and self._player.is_paused()
+
+    def pause(self):
+        if self._player:
+            self._player.pause()
+
+    def resume(self):
+        if self._player:
+            self._player.resume()
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+            self._player = None
+
+    def send_audio_packet(self, data: bytes, *, encode: bool = True):
+        if encode and self.encoder is not None:
+            self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+
+        # AudioPlayer schedules frame n for _start + n * DELAY (after the
+        # first one, which goes out immediately); a frame behind is late.
+        player = self._player
+        if player is not None:
+            behind = time.perf_counter() - (player._start + player.DELAY * player.loops)
+            if behind > player.DELAY:
+                self.late += 1
+        self.packets += 1
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild: 'FakeGuild', client_class=FakeVoiceClient):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = 'voice'
+        self.client_class = client_class
+
+    async def connect(self):
+        self.guild.voice_client = self.client_class(self)
+        return self.guild.voice_client
+
+
+class FakeTextChannel:
+    def __init__(self, guild: 'FakeGuild'):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = 'music'
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+
+class FakeMember:
+    bot = False
+
+    def __init__(self, guild: 'FakeGuild', channel: FakeVoiceChannel):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = 'listener{}'.format(self.id % 10000)
+        self.mention = '<@{}>'.format(self.id)
+        self.voice = types.SimpleNamespace(channel=channel)
+
+
+class FakeGuild:
+    def __init__(self, client_class=FakeVoiceClient):
+        self.id = next(_ids)
+        self.name = 'guild{}'.format(self.id % 100000)
+        self.voice_client = None
+        self.voice_channel = FakeVoiceChannel(self, client_class)
+        self.text_channel = FakeTextChannel(self)
+        self.member = FakeMember(self, self.voice_channel)
+
+    def get_member(self, member_id: int):
+        return self.member if member_id == self.member.id else None
+
+
+class FakeMessage:
+    _state = None
+
+    def __init__(self, guild: FakeGuild, content: str):
+        self.id = next(_ids)
+        self.guild = guild
+        self.author = guild.member
+        self.channel = guild.text_channel
+        self.content = content
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class _NoTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class BenchContext(commands.Context):
+    """Collects replies instead of sending them; an error reply marks the command failed."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.failed = False
+
+    async def send(self, content=None, **kwargs):
+        if content is not None and content.startswith('An error occurred'):
+            self.failed = True
+        return self.message
+
+    def typing(self):
+        return _NoTyping()
+
+
+class FakeGateway:
+    """Routes fake messages into ``kronos.bot`` as if Discord had delivered them."""
+
+    def __init__(self, ytdl: StubYoutubeDL):
+        self.bot = kronos.bot
+        self.cog = self.bot.get_cog('Music')
+        self.ytdl = ytdl
+        self.synthetic = True
+
+        self.bot._connection.user = types.SimpleNamespace(id=next(_ids), bot=True)
+        kronos.YTDLSource.ytdl = ytdl
+        kronos.YTDLSource.search_cache.clear()
+        kronos.YTDLSource.info_cache.clear()
+
+        self._open = kronos.YTDLSource.open.__func__
+        self.use_synthetic(True)
+
+    def use_synthetic(self, synthetic: bool):
+        self.synthetic = synthetic
+        if synthetic:
+            kronos.YTDLSource.open = classmethod(lambda cls, song, **kwargs: SyntheticSource(song, **kwargs))
+        else:
+            kronos.YTDLSource.open = classmethod(self._open)
+
+    async def command(self, guild: FakeGuild, content: str):
+        """Runs one command and returns (seconds, failed)."""
+
+        started = time.perf_counter()
+        ctx = await self.bot.get_context(FakeMessage(guild, self.bot.command_prefix + content), cls=BenchContext)
+        await self.bot.invoke(ctx)
+        return time.perf_counter() - started, ctx.failed
+
+    async def reset(self):
+        for guild_id, state in list(self.cog.voice_states.items()):
+            self.cog.lifecycle.cancel(guild_id)
+            await state.close()
+        self.cog.voice_states.clear()
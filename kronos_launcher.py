@@ -0,0 +1,278 @@
+"""Runs Kronos as several worker processes, each owning a slice of the gateway shards.
+
+    python kronos_launcher.py run --workers 4 --shards 16
+    python kronos_launcher.py status
+    python kronos_launcher.py rebalance --workers 6
+
+Workers report to the launcher over a local authenticated socket; it restarts
+the ones that die or stop reporting. Rebalancing drains every worker (queues
+are saved to the state store and restored by the new owner) and starts them
+again with the new shard split; asking for more workers than there are
+shards raises the shard count to match.
+"""
+
+import argparse
+import json
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+BOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kronos_music_bot.py')
+ADDRESS = ('127.0.0.1', int(os.environ.get('KRONOS_COORDINATOR_PORT', 7601)))
+KEY_FILE = os.environ.get('KRONOS_COORDINATOR_KEY_FILE', 'kronos_coordinator.key')
+
+
+def load_authkey():
+    if os.environ.get('KRONOS_COORDINATOR_KEY'):
+        return bytes.fromhex(os.environ['KRONOS_COORDINATOR_KEY'])
+
+    try:
+        with open(KEY_FILE) as f:
+            return bytes.fromhex(f.read().strip())
+    except FileNotFoundError:
+        pass
+
+    key = secrets.token_bytes(16)
+    fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key.hex())
+    return key
+
+
+def assign_shards(shards: int, workers: int):
+    # Interleaved rather than contiguous, so every worker gets a mix of old
+    # (big) and new (small) guilds.
+    return [list(range(index, shards, workers)) for index in range(workers)]
+
+
+class Worker:
+    def __init__(self, index: int, shard_ids: list):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process = None
+        self.conn = None
+        self.started_at = None
+        self.last_seen = None
+        self.stats = {}
+        self.restarts = 0
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def info(self):
+        return {
+            'worker': self.index,
+            'pid': self.process.pid if self.process else None,
+            'alive': self.alive,
+            'shards': self.shard_ids,
+            'restarts': self.restarts,
+            'last_seen': round(time.monotonic() - self.last_seen, 1) if self.last_seen else None,
+            'stats': self.stats,
+        }
+
+
+class Coordinator:
+    HEARTBEAT_TIMEOUT = float(os.environ.get('KRONOS_HEARTBEAT_TIMEOUT', 60))
+    STARTUP_GRACE = float(os.environ.get('KRONOS_STARTUP_GRACE', 120))
+    DRAIN_TIMEOUT = float(os.environ.get('KRONOS_DRAIN_TIMEOUT', 20))
+    CHECK_INTERVAL = 5
+
+    def __init__(self, workers: int, shards: int, authkey: bytes):
+        self.shards = shards
+        self.authkey = authkey
+        self.workers = []
+        self.lock = threading.RLock()
+        self.closing = threading.Event()
+        self.listener = Listener(ADDRESS, authkey=authkey)
+
+        self.layout(workers)
+
+    def layout(self, workers: int):
+        # A worker without shards would fall back to connecting all of them.
+        if workers > self.shards:
+            print('{} workers asked for, but there are only {} shards'.format(workers, self.shards))
+        workers = max(1, min(workers, self.shards))
+        self.workers = [Worker(index, shard_ids)
+                        for index, shard_ids in enumerate(assign_shards(self.shards, workers))]
+
+    def spawn(self, worker: Worker):
+        env = dict(os.environ,
+                   KRONOS_WORKER=str(worker.index),
+                   KRONOS_SHARD_IDS=','.join(map(str, worker.shard_ids)),
+                   KRONOS_SHARD_COUNT=str(self.shards),
+                   KRONOS_COORDINATOR='{}:{}'.format(*ADDRESS),
+                   KRONOS_COORDINATOR_KEY=self.authkey.hex())
+
+        worker.conn = None
+        worker.stats = {}
+        worker.last_seen = None
+        worker.started_at = time.monotonic()
+        worker.process = subprocess.Popen([sys.executable, BOT], env=env)
+        print('worker {} started (pid {}, shards {})'.format(worker.index, worker.process.pid, worker.shard_ids))
+
+    def drain(self, worker: Worker):
+        if not worker.alive:
+            return
+
+        try:
+            if worker.conn is not None:
+                worker.conn.send({'command': 'drain'})
+            else:
+                worker.process.terminate()
+            worker.process.wait(self.DRAIN_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            worker.process.kill()
+            worker.process.wait()
+
+    def rebalance(self, workers: int):
+        with self.lock:
+            for worker in self.workers:
+                self.drain(worker)
+
+            # Every shard reconnects anyway, so this is the one moment the
+            # shard count can grow to give each new worker a shard of its own.
+            if workers > self.shards:
+                print('resharding from {} to {} shards'.format(self.shards, workers))
+                self.shards = workers
+
+            self.layout(workers)
+            for worker in self.workers:
+                self.spawn(worker)
+
+    def status(self):
+        with self.lock:
+            workers = [worker.info() for worker in self.workers]
+
+        per_shard = {}
+        for w in workers:
+            for shard_id, shard in w['stats'].get('per_shard', {}).items():
+                per_shard[shard_id] = dict(shard, worker=w['worker'])
+
+        return {
+            'shards': self.shards,
+            'worker_count': len(workers),
+            'workers': workers,
+            'guilds': sum(w['stats'].get('guilds', 0) for w in workers),
+            'playing': sum(w['stats'].get('playing', 0) for w in workers),
+            'per_shard': dict(sorted(per_shard.items())),
+        }
+
+    def accept_forever(self):
+        while not self.closing.is_set():
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                continue
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        try:
+            hello = conn.recv()
+        except (EOFError, OSError):
+            conn.close()
+            return
+
+        if 'worker' in hello:
+            self.follow(hello['worker'], conn)
+            return
+
+        # One-shot control request from `kronos_launcher.py status/rebalance`.
+        try:
+            if hello.get('command') == 'rebalance':
+                self.rebalance(int(hello['workers']))
+            conn.send(self.status())
+        finally:
+            conn.close()
+
+    def follow(self, index: int, conn):
+        with self.lock:
+            if index >= len(self.workers):
+                conn.close()
+                return
+            worker = self.workers[index]
+            worker.conn = conn
+
+        while True:
+            try:
+                stats = conn.recv()
+            except (EOFError, OSError):
+                return
+            worker.stats = stats
+            worker.last_seen = time.monotonic()
+
+    def supervise(self):
+        while not self.closing.wait(self.CHECK_INTERVAL):
+            with self.lock:
+                now = time.monotonic()
+                for worker in self.workers:
+                    if worker.alive:
+                        if worker.last_seen is not None:
+                            deadline = worker.last_seen + self.HEARTBEAT_TIMEOUT
+                        else:
+                            deadline = worker.started_at + self.STARTUP_GRACE
+                        if now < deadline:
+                            continue
+                        print('worker {} stopped reporting, restarting'.format(worker.index))
+                        worker.process.kill()
+                        worker.process.wait()
+                    else:
+                        print('worker {} exited with {}, restarting'.format(worker.index, worker.process.returncode))
+
+                    worker.restarts += 1
+                    self.spawn(worker)
+
+    def run(self):
+        threading.Thread(target=self.accept_forever, name='kronos-accept', daemon=True).start()
+        with self.lock:
+            for worker in self.workers:
+                self.spawn(worker)
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: self.closing.set())
+
+        try:
+            self.supervise()
+        finally:
+            with self.lock:
+                for worker in self.workers:
+                    self.drain(worker)
+            self.listener.close()
+
+
+def request(message: dict):
+    with Client(ADDRESS, authkey=load_authkey()) as conn:
+        conn.send(message)
+        return conn.recv()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run Kronos across several sharded worker processes.')
+    sub = parser.add_subparsers(dest='action', required=True)
+
+    run = sub.add_parser('run', help='start the coordinator and its workers')
+    run.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    run.add_argument('--shards', type=int, default=None, help='total gateway shards (default: one per worker)')
+
+    sub.add_parser('status', help='print per-worker and per-shard stats')
+
+    rebalance = sub.add_parser('rebalance', help='drain and restart with a different worker count')
+    rebalance.add_argument('--workers', type=int, required=True)
+
+    args = parser.parse_args(argv)
+
+    if args.action == 'run':
+        Coordinator(args.workers, args.shards or args.workers, load_authkey()).run()
+    elif args.action == 'status':
+        print(json.dumps(request({'command': 'status'}), indent=2))
+    else:
+        print(json.dumps(request({'command': 'rebalance', 'workers': args.workers}), indent=2))
+
+
+if __name__ == '__main__':
+    main()
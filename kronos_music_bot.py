@@ -1,20 +1,46 @@
+import time
+
+# Taken before any other import so the startup profile covers all of them,
+# standard library included.
+IMPORT_STARTED = time.perf_counter()
+
 import os
 
 from random import choice
 
 import asyncio
+import audioop
+import bisect
+import collections
+import concurrent.futures
 import functools
+import http.client
 import itertools
+import json
 import math
+import mmap
+import multiprocessing.connection
 import random
+import re
+import shlex
+import sqlite3
+import subprocess
+import sys
+import threading
+import types
+import urllib.error
+import urllib.parse
+import urllib.request
+import weakref
 
 import discord
-import youtube_dl
 from async_timeout import timeout
 from discord.ext import commands
 
-# Silence useless bug reports messages
-youtube_dl.utils.bug_reports_message = lambda: ''
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class VoiceError(Exception):
@@ -25,177 +51,2933 @@ class YTDLError(Exception):
     pass
 
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    YTDL_OPTIONS = {
-        'format': 'bestaudio/best',
-        'extractaudio': True,
-        'audioformat': 'mp3',
-        'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
-        'restrictfilenames': True,
-        'noplaylist': True,
-        'nocheckcertificate': True,
-        'ignoreerrors': False,
-        'logtostderr': False,
-        'quiet': True,
-        'no_warnings': True,
-        'default_search': 'auto',
-        'source_address': '0.0.0.0',
-    }
+class ExtractorBusy(YTDLError):
+    pass
+
+
+class FFmpegBusy(YTDLError):
+    pass
+
+
+def extract_webpage_url(search: str):
+    # Module level so it can be shipped to extractor worker processes.
+    if not urllib.parse.urlparse(search).scheme and not re.match(r'^[^\s/]+\.[^\s/]+/', search):
+        # Anything that isn't a URL is a YouTube search; only the YouTube
+        # extractors are loaded, so there's no generic fallback to guess with.
+        search = 'ytsearch:' + search
+
+    data = YTDLSource.extractor().extract_info(search, download=False, process=False)
+    if data is None:
+        return None
+
+    if 'entries' not in data:
+        return data['webpage_url']
+
+    for entry in data['entries']:
+        if entry:
+            return entry['webpage_url']
+
+    return None
+
+
+def extract_track(webpage_url: str):
+    processed_info = YTDLSource.extractor().extract_info(webpage_url, download=False)
+    if processed_info is None:
+        return None
+
+    if 'entries' not in processed_info:
+        info = processed_info
+    else:
+        info = None
+        while info is None:
+            try:
+                info = processed_info['entries'].pop(0)
+            except IndexError:
+                raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
+
+    # The raw info dict (formats, thumbnails, description, ...) is tens of
+    # KB per track; only the compact record ever leaves the worker.
+    return Track.from_info(info), Stream(info['url'], info.get('acodec'))
+
+
+def extract_playlist(url: str, limit: int, start: int = 0):
+    data = YTDLSource.extractor().extract_info(url, download=False, process=False)
+    if data is None:
+        return None
+
+    # Only keep what a queued placeholder needs; the flat entries (and the
+    # page data behind them) are dropped as soon as we've walked them.
+    # Entries are fetched page by page as they're walked, so stopping at
+    # `limit` doesn't request the pages after it.
+    entries = []
+    for entry in itertools.islice(data.get('entries') or (), start, limit):
+        if not entry:
+            continue
+
+        if entry.get('ie_key') == 'Youtube' and entry.get('id'):
+            webpage_url = 'https://www.youtube.com/watch?v={}'.format(entry['id'])
+        else:
+            webpage_url = entry.get('webpage_url') or entry.get('url')
+
+        if webpage_url:
+            entries.append((webpage_url, entry.get('title')))
+
+    return data.get('title'), entries
+
+
+def extract_candidates(search: str, limit: int):
+    data = YTDLSource.extractor().extract_info('ytsearch{}:{}'.format(limit, search), download=False, process=False)
+    if data is None:
+        return []
+
+    # Flat search results already carry everything the picker shows.
+    candidates = []
+    for entry in itertools.islice(data.get('entries') or (), limit):
+        if entry and entry.get('id'):
+            candidates.append(Track(entry['id'], entry.get('title'), entry.get('uploader'), None,
+                                    int(entry.get('duration') or 0),
+                                    'https://www.youtube.com/watch?v={}'.format(entry['id']), None))
+
+    return candidates
+
+
+class ExtractorPool:
+    def __init__(self, max_workers: int = 4, *, use_processes: bool = False,
+                 max_pending: int = 64, max_pending_per_guild: int = 4):
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        self.max_pending = max_pending
+        self.max_pending_per_guild = max_pending_per_guild
+
+        self._executor = None
+        self._queues = collections.OrderedDict()
+        self._pending = 0
+        self._running = 0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.use_processes:
+                self._executor = concurrent.futures.ProcessPoolExecutor(self.max_workers)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(self.max_workers,
+                                                                       thread_name_prefix='kronos-extractor')
+
+        return self._executor
+
+    @property
+    def saturated(self):
+        return self._running >= self.max_workers and self._pending >= self.max_pending
+
+    async def submit(self, key, func, *args, queued: bool = False, loop: asyncio.BaseEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+
+        queue = self._queues.get(key)
+        # Songs already in a queue (placeholders, restored or expired ones)
+        # wait their turn; only new requests get turned away.
+        full = self._pending >= self.max_pending or (queue and len(queue) >= self.max_pending_per_guild)
+        if full and not queued:
+            raise ExtractorBusy('The extractor is busy right now, please try again in a few seconds.')
+
+        if queue is None:
+            queue = self._queues[key] = collections.deque()
+
+        job = (loop.create_future(), func, args)
+        queue.append(job)
+        self._pending += 1
+        self._dispatch(loop)
+
+        try:
+            return await job[0]
+        except asyncio.CancelledError:
+            # The request went away before a worker picked it up.
+            if job in queue:
+                queue.remove(job)
+                self._pending -= 1
+                if not queue and self._queues.get(key) is queue:
+                    del self._queues[key]
+            raise
+
+    def cancel(self, key):
+        queue = self._queues.pop(key, None)
+        if not queue:
+            return
+
+        self._pending -= len(queue)
+        for waiter, _, _ in queue:
+            if not waiter.done():
+                waiter.set_exception(YTDLError('The request was cancelled.'))
+
+    def shutdown(self):
+        for key in list(self._queues):
+            self.cancel(key)
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _dispatch(self, loop):
+        # Hand out free workers round-robin across guilds so a single guild
+        # pasting a pile of requests can't starve everybody else.
+        while self._running < self.max_workers and self._queues:
+            key, queue = next(iter(self._queues.items()))
+            waiter, func, args = queue.popleft()
+            self._pending -= 1
+
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+
+            if waiter.done():
+                continue
+
+            self._running += 1
+            future = asyncio.wrap_future(self.executor.submit(func, *args), loop=loop)
+            future.add_done_callback(functools.partial(self._finished, loop, waiter))
+
+    def _finished(self, loop, waiter, future):
+        self._running -= 1
+
+        if not waiter.done():
+            if future.cancelled():
+                waiter.cancel()
+            elif future.exception() is not None:
+                waiter.set_exception(future.exception())
+            else:
+                waiter.set_result(future.result())
+
+        self._dispatch(loop)
+
+    def stats(self):
+        return {'workers': self.max_workers, 'running': self._running,
+                'pending': self._pending, 'guilds': len(self._queues)}
+
+
+class PooledResponse(http.client.HTTPResponse):
+    def __init__(self, sock, *args, release=None, **kwargs):
+        super().__init__(sock, *args, **kwargs)
+        self._release = release
+        self._drained = True
+
+    def close(self):
+        # Closed with part of the body still unread: the connection can't
+        # be used for another request.
+        if self.fp is not None and self.length != 0:
+            self._drained = False
+        super().close()
+
+    def _close_conn(self):
+        super()._close_conn()
+        release, self._release = self._release, None
+        if release is not None:
+            release(self._drained and not self.will_close)
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections for youtube_dl, shared by every extraction.
+
+    install() points the do_open of the opener's HTTP handlers here, so the
+    search page, watch page and API requests of every track go over a few
+    long-lived connections per host instead of a new TCP/TLS handshake each.
+    A connection goes back to the pool once its response has been read to
+    the end; no more than `per_host` (or `host_limits[host]`) are open to a
+    host at once.
+    """
+
+    def __init__(self, *, per_host: int = 4, host_limits: dict = None, idle_timeout: float = 60, wait: float = 30):
+        self.per_host = per_host
+        self.host_limits = host_limits or {}
+        self.idle_timeout = idle_timeout
+        self.wait = wait
+
+        self.connections = 0
+        self.requests = 0
+        self.reused = 0
+        self.retries = 0
+
+        self._idle = collections.defaultdict(list)
+        self._active = collections.Counter()
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def parse_limits(spec: str):
+        limits = {}
+        for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+            host, _, limit = item.partition('=')
+            limits[host.strip()] = int(limit)
+        return limits
+
+    def limit(self, host: str):
+        return self.host_limits.get(host.rpartition(':')[0] if ':' in host else host, self.per_host)
+
+    def install(self, ytdl):
+        for handler in ytdl._opener.handlers:
+            if isinstance(handler, urllib.request.AbstractHTTPHandler):
+                handler.do_open = functools.partial(self.open, handler)
+
+    def acquire(self, key, factory):
+        deadline = time.monotonic() + self.wait
+        with self._condition:
+            while True:
+                idle = self._idle[key]
+                while idle:
+                    conn, since = idle.pop()
+                    if conn.sock is not None and time.monotonic() - since < self.idle_timeout:
+                        self._active[key] += 1
+                        self.reused += 1
+                        return conn, True
+                    conn.close()
+
+                remaining = deadline - time.monotonic()
+                # Past the deadline a connection is opened anyway, rather
+                # than waiting forever on one a caller never gave back.
+                if self._active[key] < self.limit(key[1]) or remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            self._active[key] += 1
+            self.connections += 1
+
+        return factory(), False
+
+    def release(self, key, conn, reusable: bool):
+        with self._condition:
+            self._active[key] -= 1
+            if reusable and conn.sock is not None and len(self._idle[key]) < self.limit(key[1]):
+                self._idle[key].append((conn, time.monotonic()))
+                conn = None
+            self._condition.notify()
+
+        if conn is not None:
+            conn.close()
+
+    def open(self, handler, http_class, req, **http_conn_args):
+        """urllib's AbstractHTTPHandler.do_open, minus the Connection: close."""
+
+        host = req.host
+        if not host:
+            raise urllib.error.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers['Connection'] = 'keep-alive'
+        headers = {name.title(): val for name, val in headers.items()}
+
+        tunnel_headers = {}
+        if req._tunnel_host and 'Proxy-Authorization' in headers:
+            # Proxy-Authorization should not be sent to origin server.
+            tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+
+        key = (req.type, host, req._tunnel_host, type(handler))
+        while True:
+            conn, reused = self.acquire(key, functools.partial(http_class, host, timeout=req.timeout,
+                                                               **http_conn_args))
+            if not reused:
+                conn.set_debuglevel(handler._debuglevel)
+                if req._tunnel_host:
+                    conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+
+            lease = [key, conn]
+
+            def release(reusable: bool, lease=lease):
+                # Whichever comes first: the response being done, or the request failing.
+                if lease:
+                    self.release(*lease, reusable)
+                    lease.clear()
+
+            conn.response_class = functools.partial(PooledResponse, release=release)
+            self.requests += 1
+            try:
+                conn.request(req.get_method(), req.selector, req.data, headers,
+                             encode_chunked=req.has_header('Transfer-encoding'))
+                response = conn.getresponse()
+            except (OSError, http.client.HTTPException) as err:
+                release(False)
+                if reused and not isinstance(err, TimeoutError):
+                    # The server dropped the connection while it sat in the pool.
+                    self.retries += 1
+                    continue
+                if isinstance(err, OSError):
+                    raise urllib.error.URLError(err)
+                raise
+
+            response.url = req.get_full_url()
+            response.msg = response.reason
+            return response
+
+    def stats(self):
+        with self._condition:
+            idle = sum(len(idle) for idle in self._idle.values())
+            active = sum(self._active.values())
+        return {'connections': self.connections, 'requests': self.requests, 'reused': self.reused,
+                'retries': self.retries, 'active': active, 'idle': idle}
+
+
+class ResolutionCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        if expires < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, *, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttl
+
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+
+        # Evict the least recently used entries once we grow past the bound.
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts: list, total: float):
+        for i, n in enumerate(counts):
+            self.counts[i] += n
+        self.sum += total
+        self.count += sum(counts)
+
+    def quantile(self, q: float):
+        """Upper bound of the bucket holding the q-th observation."""
+
+        if not self.count:
+            return None
+
+        seen = 0
+        for bound, n in zip(self.buckets + (math.inf,), self.counts):
+            seen += n
+            if seen >= q * self.count:
+                return bound
+
+
+class FrameClock:
+    """Tracks how far apart the audio thread pulls frames, against Discord's 20 ms.
+
+    Called for every frame, so counts stay local to the source and are only
+    handed to the shared histogram every few seconds.
+    """
+
+    __slots__ = ('started', 'last', 'counts', 'sum', 'pending')
+
+    FLUSH_FRAMES = 250
+
+    def __init__(self):
+        self.started = None
+        self.last = None
+        self.counts = [0] * (len(Metrics.JITTER_BUCKETS) + 1)
+        self.sum = 0.0
+        self.pending = 0
+
+    def tick(self):
+        now = time.perf_counter()
+
+        if self.last is None:
+            if self.started is not None:
+                metrics.observe('kronos_stage_seconds', now - self.started, stage='first_packet')
+        else:
+            jitter = abs(now - self.last - 0.02)
+            # Anything this long is a pause, not jitter.
+            if jitter < 1:
+                self.counts[bisect.bisect_left(Metrics.JITTER_BUCKETS, jitter)] += 1
+                self.sum += jitter
+                self.pending += 1
+
+                if self.pending >= self.FLUSH_FRAMES:
+                    self.flush()
+
+        self.last = now
+
+    def flush(self):
+        if self.pending:
+            metrics.merge('kronos_frame_jitter_seconds', self.counts, self.sum, buckets=Metrics.JITTER_BUCKETS)
+            self.counts = [0] * len(self.counts)
+            self.sum = 0.0
+            self.pending = 0
+
+
+class Metrics:
+    """In-process counters, gauges and histograms, rendered in Prometheus text format.
+
+    Histograms have fixed buckets, so recording is a bisect and two additions;
+    gauges are callbacks that only run when someone asks for the numbers.
+    """
+
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    JITTER_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25)
+
+    LAG_INTERVAL = float(os.environ.get('KRONOS_LAG_INTERVAL', 0.5))
+    HOST = os.environ.get('KRONOS_METRICS_HOST', '127.0.0.1')
+    PORT = os.environ.get('KRONOS_METRICS_PORT')
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.loop_lag = 0.0
+        self._lock = threading.Lock()
+        self._monitor = None
+        self._server = None
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
+
+    def histogram(self, name: str, buckets: tuple = LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def observe(self, name: str, value: float, **labels):
+        histogram = self.histogram(name, **labels)
+        with self._lock:
+            histogram.observe(value)
+
+    def merge(self, name: str, counts: list, total: float, *, buckets: tuple, **labels):
+        histogram = self.histogram(name, buckets, **labels)
+        with self._lock:
+            histogram.merge(counts, total)
+
+    def inc(self, name: str, value: int = 1, **labels):
+        with self._lock:
+            self.counters[self._key(name, labels)] += value
+
+    def gauge(self, name: str, func):
+        """Registers `func`, returning (labels, value) pairs, to be read at scrape time."""
+
+        self.gauges[name] = func
+
+    def start(self, loop: asyncio.BaseEventLoop):
+        if self._monitor is None:
+            self._monitor = loop.create_task(self.monitor_task())
+
+        if self.PORT and self._server is None:
+            # Every launcher worker gets its own port after the base one.
+            port = int(self.PORT) + int(os.environ.get('KRONOS_WORKER', 0))
+            self._server = loop.create_task(asyncio.start_server(self.handle, self.HOST, port))
+
+    async def monitor_task(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.LAG_INTERVAL)
+            self.loop_lag = max(time.perf_counter() - started - self.LAG_INTERVAL, 0.0)
+            self.observe('kronos_loop_lag_seconds', self.loop_lag)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            path = request.split(b' ', 2)[1]
+
+            if path.split(b'?')[0] in (b'/', b'/metrics'):
+                body = self.render().encode()
+                head = 'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+            else:
+                body = b'Not found\n'
+                head = 'HTTP/1.1 404 Not Found\r\nContent-Type: text/plain\r\n'
+
+            head += 'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(len(body))
+            writer.write(head.encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, IndexError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in labels) + '}'
+
+    def render(self):
+        lines = []
+
+        for name, func in sorted(self.gauges.items()):
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in func():
+                lines.append('{}{} {}'.format(name, self._labels(sorted(labels.items())), value))
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, list(h.buckets), list(h.counts), h.sum, h.count)
+                          for key, h in sorted(self.histograms.items())]
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} counter'.format(name))
+            lines.append('{}{} {}'.format(name, self._labels(labels), value))
+
+        for (name, labels), buckets, counts, total, count in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+
+            cumulative = 0
+            for bound, n in zip(buckets + ['+Inf'], counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(name, self._labels(labels + (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, self._labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, self._labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class StartupProfile:
+    """How long each step between starting the process and on_ready took."""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.phases = collections.OrderedDict()
+        self._last = started
+
+    def mark(self, phase: str, elapsed: float = None):
+        # Without `elapsed` a phase runs from the previous mark until now.
+        now = time.perf_counter()
+        if elapsed is None:
+            elapsed = now - self._last
+            self._last = now
+        self.phases.setdefault(phase, elapsed)
+
+    @property
+    def ready(self):
+        return self.phases.get('ready') is not None
+
+    def total(self):
+        return self._last - self.started
+
+    def report(self):
+        return ', '.join('{} {:.0f}ms'.format(phase, elapsed * 1000) for phase, elapsed in self.phases.items())
+
+    def samples(self):
+        return [({'phase': phase}, round(elapsed, 6)) for phase, elapsed in self.phases.items()]
+
+
+startup = StartupProfile(IMPORT_STARTED)
+startup.mark('imports')
+metrics.gauge('kronos_startup_seconds', startup.samples)
+
+
+class Track(collections.namedtuple('Track', 'id title uploader uploader_url length url thumbnail')):
+    __slots__ = ()
+
+    @classmethod
+    def from_info(cls, data: dict):
+        return cls(sys.intern(data['id']), data.get('title'), data.get('uploader'), data.get('uploader_url'),
+                   int(data.get('duration') or 0), data.get('webpage_url'), data.get('thumbnail'))
+
+    @classmethod
+    def placeholder(cls, url: str, title: str = None):
+        return cls(None, title or url, None, None, 0, url, None)
+
+    @property
+    def duration(self):
+        return YTDLSource.parse_duration(self.length)
+
+
+Stream = collections.namedtuple('Stream', 'url codec')
+
+
+class SQLiteStore:
+    """A SQLite file shared with other launcher workers: WAL, read on the event loop, written on one thread.
+
+    Subclasses set SCHEMA. `reader` is for the event loop, `writer` only for
+    functions handed to submit() or run(), which all go through the one
+    writer thread in order.
+    """
+
+    SCHEMA = ''
+
+    def __init__(self, path: str, *, name: str):
+        self.path = path
+        self._reader = None
+        self._writer = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='kronos-' + name)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(self.SCHEMA)
+        return db
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            self._reader = self._connect()
+
+        return self._reader
+
+    @property
+    def writer(self):
+        if self._writer is None:
+            self._writer = self._connect()
+
+        return self._writer
+
+    def submit(self, func, *args):
+        return self._executor.submit(func, *args)
+
+    async def run(self, func, *args, loop: asyncio.BaseEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+
+class LoudnessIndex(SQLiteStore):
+    """Integrated loudness (EBU R128) per video id, measured once and kept on disk.
+
+    Lookups read on the event loop; measurements are written through a
+    single writer thread, so launcher workers sharing the file don't block
+    each other's loops.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS loudness (
+            video_id TEXT PRIMARY KEY,
+            lufs REAL NOT NULL,
+            analyzed_at REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path: str, *, target: float = -14.0, concurrency: int = 2, enabled: bool = True):
+        super().__init__(path, name='loudness')
+        self.target = target
+        self.concurrency = concurrency
+        self.enabled = enabled
+
+        self._loudness = ResolutionCache(maxsize=8192, ttl=float('inf'))
+        self._pending = set()
+        self._semaphore = None
+
+    def lookup(self, video_id: str):
+        lufs = self._loudness.get(video_id)
+        if lufs is None:
+            row = self.reader.execute('SELECT lufs FROM loudness WHERE video_id = ?', (video_id,)).fetchone()
+            if row is not None:
+                lufs = row[0]
+                self._loudness.put(video_id, lufs)
+
+        return lufs
+
+    def factor(self, video_id: str):
+        """Linear gain that brings a track to the target loudness, 1.0 until it has been analyzed."""
+
+        if not self.enabled or not video_id:
+            return 1.0
+
+        lufs = self.lookup(video_id)
+        if lufs is None or lufs <= -70:
+            return 1.0
+
+        gain = min(6.0, max(-12.0, self.target - lufs))
+        return 10 ** (gain / 20)
+
+    def store(self, video_id: str, lufs: float):
+        self._loudness.put(video_id, lufs)
+        self.submit(self._store, video_id, lufs, time.time())
+
+    def _store(self, video_id: str, lufs: float, now: float):
+        with self.writer as db:
+            db.execute('INSERT OR REPLACE INTO loudness VALUES (?, ?, ?)', (video_id, lufs, now))
+
+    def schedule(self, song: 'Song', *, loop: asyncio.BaseEventLoop = None):
+        video_id = song.track.id
+        if not self.enabled or not video_id or video_id in self._pending or self.lookup(video_id) is not None:
+            return
+
+        loop = loop or asyncio.get_event_loop()
+        self._pending.add(video_id)
+        loop.create_task(self._analyze(video_id, song.stream.url))
+
+    async def _analyze(self, video_id: str, url: str):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        try:
+            async with self._semaphore:
+                lufs = await self.measure(url)
+
+            if lufs is not None:
+                self.store(video_id, lufs)
+        finally:
+            self._pending.discard(video_id)
+
+    @staticmethod
+    async def measure(url: str):
+        threads = YTDLSource.governor.thread_args()
+        args = ['ffmpeg', '-hide_banner', '-nostats', *threads]
+        args += shlex.split(YTDLSource.FFMPEG_OPTIONS['before_options'])
+        args += ['-i', url, '-vn', *threads, '-af', 'ebur128', '-f', 'null', '-']
+
+        try:
+            process = await YTDLSource.governor.spawn(*args, stdin=subprocess.DEVNULL,
+                                                      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except OSError:
+            return None
+
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        finally:
+            YTDLSource.governor.release(process)
+
+        # The summary at the end holds the integrated loudness of the whole track.
+        matches = re.findall(rb'I:\s+(-?\d+(?:\.\d+)?) LUFS', stderr)
+        return float(matches[-1]) if matches else None
+
+
+class TrackHistory(SQLiteStore):
+    """Every track the bot has resolved, with a trigram index for fuzzy lookups.
+
+    Titles and uploaders are split into padded character trigrams; a query
+    scores by the share of its own trigrams a track contains, so typos and
+    missing words still match. Ties go to the shorter title, then to the most
+    played track. That score alone would let one word stand for any title
+    holding it, so match() also wants the Dice coefficient of the query and
+    the track's trigrams to reach `similarity` before it skips the search.
+    Only tracks holding one of the query's rarest trigrams are scored: with n
+    trigrams, any track scoring at least s has to contain one of the rarest
+    n - ceil(s * n) + 1; the ones holding most of those get scored in full.
+    search() and match() read on the calling thread; their _async versions and
+    every write go through a single writer thread.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS tracks (
+            video_id TEXT PRIMARY KEY,
+            title TEXT,
+            uploader TEXT,
+            uploader_url TEXT,
+            length INTEGER NOT NULL,
+            url TEXT,
+            thumbnail TEXT,
+            grams INTEGER NOT NULL DEFAULT 0,
+            plays INTEGER NOT NULL DEFAULT 0,
+            last_played REAL
+        );
+        CREATE TABLE IF NOT EXISTS trigrams (
+            gram TEXT NOT NULL,
+            video_id TEXT NOT NULL,
+            PRIMARY KEY (gram, video_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS grams (
+            gram TEXT PRIMARY KEY,
+            tracks INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS searches (
+            query TEXT PRIMARY KEY,
+            video_id TEXT NOT NULL
+        );
+    '''
+
+    MAX_QUERY = 200
+    MAX_CANDIDATES = 250
+
+    def __init__(self, path: str, *, threshold: float = 0.9, similarity: float = 0.6, enabled: bool = True):
+        super().__init__(path, name='history')
+        self.threshold = threshold
+        self.similarity = similarity
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+        self._known = set()
+
+    @classmethod
+    def trigrams(cls, text: str):
+        grams = set()
+        for word in re.findall(r'\w+', text.casefold()):
+            padded = '  {} '.format(word)
+            grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+
+        return grams
+
+    @staticmethod
+    def _params(values):
+        return ','.join('?' * len(values))
+
+    def search(self, query: str, limit: int = 5, min_score: float = 0.5):
+        """The best `limit` local matches for `query` as (track, score) pairs, score in 0-1."""
+
+        return self._search(self.reader, query, limit, min_score)
+
+    async def search_async(self, query: str, limit: int = 5, min_score: float = 0.5, *,
+                           loop: asyncio.BaseEventLoop = None):
+        # Broad queries can have to score a few hundred tracks; keep that off the event loop.
+        return await self.run(lambda: self._search(self.writer, query, limit, min_score), loop=loop)
+
+    def _search(self, db: sqlite3.Connection, query: str, limit: int, min_score: float, similarity: float = 0):
+        grams = list(self.trigrams(query[:self.MAX_QUERY]))
+        if not self.enabled or not grams:
+            return []
+
+        frequency = dict(db.execute(
+            'SELECT gram, tracks FROM grams WHERE gram IN ({})'.format(self._params(grams)), grams))
+        grams.sort(key=lambda gram: frequency.get(gram, 0))
+        probes = [gram for gram in grams[:len(grams) - math.ceil(min_score * len(grams)) + 1] if gram in frequency]
+        if not probes:
+            return []
+
+        candidates = [video_id for video_id, in db.execute(
+            'SELECT video_id FROM trigrams WHERE gram IN ({}) GROUP BY video_id ORDER BY COUNT(*) DESC '
+            'LIMIT ?'.format(self._params(probes)), (*probes, self.MAX_CANDIDATES))]
+
+        rows = db.execute(
+            'SELECT video_id, title, uploader, uploader_url, length, url, thumbnail, shared FROM ('
+            'SELECT video_id, COUNT(*) AS shared FROM trigrams WHERE gram IN ({}) AND video_id IN ({}) '
+            'GROUP BY video_id) JOIN tracks USING (video_id) '
+            'WHERE shared >= ? AND 2.0 * shared >= ? * (? + tracks.grams) '
+            'ORDER BY shared DESC, tracks.grams, plays DESC LIMIT ?'.format(self._params(grams),
+                                                                        self._params(candidates)),
+            (*grams, *candidates, min_score * len(grams), similarity, len(grams), limit))
+
+        return [(Track(*row[:7]), row[7] / len(grams)) for row in rows]
+
+    def match(self, search: str):
+        """The track `search` most likely means, if the history is confident enough."""
+
+        return self._match(self.reader, search)
+
+    async def match_async(self, search: str, *, loop: asyncio.BaseEventLoop = None):
+        if not self.enabled:
+            return None
+
+        return await self.run(lambda: self._match(self.writer, search), loop=loop)
+
+    def _match(self, db: sqlite3.Connection, search: str):
+        if not self.enabled:
+            return None
+
+        query = YTDLSource.normalize_search(search)
+        row = db.execute('SELECT video_id, title, uploader, uploader_url, length, url, thumbnail '
+                         'FROM searches JOIN tracks USING (video_id) WHERE query = ?', (query,)).fetchone()
+        if row is not None:
+            track = Track(*row)
+        elif '://' in query:
+            track = None
+        else:
+            best = self._search(db, query, 1, self.threshold, self.similarity)
+            track = best[0][0] if best else None
+
+        if track is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return track
+
+    def record(self, track: Track, searches: tuple = ()):
+        searches = [YTDLSource.normalize_search(search) for search in searches if search and '://' not in search]
+        if self.enabled and track.id and (track.id not in self._known or searches):
+            self.submit(self._record, track, searches, track.id not in self._known)
+            self._known.add(track.id)
+
+    def played(self, track: Track):
+        if self.enabled and track.id:
+            self.submit(self._played, track.id, time.time())
+
+    def _record(self, track: Track, searches: list, new: bool):
+        with self.writer as db:
+            if new:
+                self._index(db, track)
+
+            db.executemany('INSERT OR REPLACE INTO searches VALUES (?, ?)',
+                           ((search, track.id) for search in searches))
+
+    def _index(self, db: sqlite3.Connection, track: Track):
+        grams = self.trigrams('{} {}'.format(track.title or '', track.uploader or ''))
+        indexed = db.execute('SELECT title, uploader FROM tracks WHERE video_id = ?', (track.id,)).fetchone()
+
+        db.execute('INSERT INTO tracks (video_id, title, uploader, uploader_url, length, url, thumbnail, grams) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (video_id) DO UPDATE SET '
+                   'title = excluded.title, uploader = excluded.uploader, uploader_url = excluded.uploader_url, '
+                   'length = excluded.length, url = excluded.url, thumbnail = excluded.thumbnail, '
+                   'grams = excluded.grams', (*track, len(grams)))
+
+        if indexed is not None:
+            old = self.trigrams('{} {}'.format(indexed[0] or '', indexed[1] or ''))
+            if old == grams:
+                return
+
+            db.executemany('DELETE FROM trigrams WHERE gram = ? AND video_id = ?', ((gram, track.id) for gram in old))
+            db.executemany('UPDATE grams SET tracks = tracks - 1 WHERE gram = ?', ((gram,) for gram in old))
+
+        db.executemany('INSERT INTO trigrams VALUES (?, ?)', ((gram, track.id) for gram in grams))
+        db.executemany('INSERT INTO grams VALUES (?, 1) ON CONFLICT (gram) DO UPDATE SET tracks = tracks + 1',
+                       ((gram,) for gram in grams))
+
+    def _played(self, video_id: str, now: float):
+        with self.writer as db:
+            db.execute('UPDATE tracks SET plays = plays + 1, last_played = ? WHERE video_id = ?', (now, video_id))
+
+    def stats(self):
+        tracks = self.reader.execute('SELECT COUNT(*) FROM tracks').fetchone()[0] if self.enabled else 0
+        return {'tracks': tracks, 'hits': self.hits, 'misses': self.misses}
+
+
+class AudioCache:
+    """Opus copies of played tracks on local disk, keyed by video id.
+
+    A track is copied in the background while it's first played; later plays
+    (loops included) read the local file instead of the network. Once the
+    directory grows past `max_bytes`, the least frequently used files are
+    evicted first, least recently used among equals. Use counts only live
+    in memory, recency survives restarts through the file mtimes.
+
+    Launcher workers can share the directory: copies go to per-process
+    temporary files, and the size is taken from the directory itself
+    before anything is evicted.
+    """
+
+    # A temporary file nobody has written to for this long belongs to a copy that died.
+    STALE_PART = 600
+
+    def __init__(self, directory: str, *, max_bytes: int, max_length: int = 900, concurrency: int = 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_length = max_length
+        self.concurrency = concurrency
+        self.enabled = bool(directory)
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = None
+        self._size = 0
+        self._pending = set()
+        self._semaphore = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._scan()
+
+        return self._entries
+
+    def _scan(self):
+        known_entries = self._entries or {}
+        entries = {}
+        size = 0
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith('.part'):
+                    if now - stat.st_mtime > self.STALE_PART:
+                        os.remove(entry.path)
+                elif entry.name.endswith('.ogg'):
+                    # Use counts of files another worker copied start at zero.
+                    known = known_entries.get(entry.name[:-4])
+                    entries[entry.name[:-4]] = [stat.st_size, known[1] if known else 0, stat.st_mtime]
+                    size += stat.st_size
+            except FileNotFoundError:
+                pass  # Evicted or renamed by another worker meanwhile.
+
+        self._entries = entries
+        self._size = size
+
+    def _file(self, video_id: str):
+        return os.path.join(self.directory, video_id + '.ogg')
+
+    def path(self, video_id: str):
+        """Local file for a track if it's cached, counting it as used."""
+
+        if not self.enabled or not video_id:
+            return None
+
+        entry = self.entries.get(video_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        path = self._file(video_id)
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except FileNotFoundError:
+            self._forget(video_id)
+            self.misses += 1
+            return None
+
+        entry[1] += 1
+        entry[2] = now
+        self.hits += 1
+        return path
+
+    def schedule(self, song: 'Song', *, loop: asyncio.BaseEventLoop = None):
+        video_id = song.track.id
+        if (not self.enabled or not video_id or not re.fullmatch(r'[\w-]+', video_id)
+                or video_id in self._pending or video_id in self.entries
+                or not 0 < song.length <= self.max_length):
+            return
+
+        loop = loop or asyncio.get_event_loop()
+        self._pending.add(video_id)
+        loop.create_task(self._fill(video_id, song.stream))
+
+    async def _fill(self, video_id: str, stream: 'Stream'):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        part = '{}.{}.part'.format(self._file(video_id), os.getpid())
+        try:
+            async with self._semaphore:
+                copied = await self.copy(stream, part)
+
+            if copied and os.path.getsize(part) > 0:
+                os.replace(part, self._file(video_id))
+                self._evict()
+        finally:
+            self._pending.discard(video_id)
+            if os.path.exists(part):
+                os.remove(part)
+
+    @staticmethod
+    async def copy(stream: 'Stream', path: str):
+        threads = YTDLSource.governor.thread_args()
+        args = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', *threads]
+        args += shlex.split(YTDLSource.FFMPEG_OPTIONS['before_options'])
+        args += ['-i', stream.url, '-vn', '-map_metadata', '-1', *threads]
+        if stream.codec == 'opus':
+            args += ['-c:a', 'copy']
+        else:
+            args += ['-c:a', 'libopus', '-b:a', '{}k'.format(YTDLSource.OPUS_BITRATE)]
+        args += ['-f', 'opus', '-y', path]
+
+        try:
+            process = await YTDLSource.governor.spawn(*args, stdin=subprocess.DEVNULL,
+                                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError:
+            return False
+
+        try:
+            return await process.wait() == 0
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        finally:
+            YTDLSource.governor.release(process)
+
+    def _forget(self, video_id: str):
+        entry = self.entries.pop(video_id, None)
+        if entry is not None:
+            self._size -= entry[0]
+
+    def _evict(self):
+        # Other workers fill the same directory, so go by what's on disk.
+        self._scan()
+        while self._size > self.max_bytes and self.entries:
+            video_id = min(self.entries, key=lambda v: (self.entries[v][1], self.entries[v][2]))
+            try:
+                os.remove(self._file(video_id))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Still mapped by a player on platforms that don't allow
+                # removing open files; try again on the next eviction.
+                return
+            self._forget(video_id)
+
+    def stats(self):
+        return {'files': len(self.entries) if self.enabled else 0, 'bytes': self._size,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class FFmpegGovernor:
+    """Keeps count of, and a lid on, every FFmpeg process the bot runs.
+
+    Playback waits in admit() while `limit` processes are running, background
+    jobs (loudness scans, cache copies) while half of them are. Processes are
+    reniced below the bot so they can't starve the event loop. A watchdog
+    kills playback processes a reader has been blocked on for longer than
+    `stall_timeout` (FFmpeg hanging in -reconnect) and background ones that
+    outlive `background_timeout`, and samples their CPU time.
+    """
+
+    BACKGROUND_SHARE = 0.5
+
+    def __init__(self, *, limit: int, threads: int = 1, nice: int = 5, background_nice: int = 15,
+                 stall_timeout: float = 20, background_timeout: float = 600, wait: float = 10, interval: float = 2):
+        self.limit = limit
+        self.threads = threads
+        self.nice = nice
+        self.background_nice = background_nice
+        self.stall_timeout = stall_timeout
+        self.background_timeout = background_timeout
+        self.wait = wait
+        self.interval = interval
+
+        self.spawned = 0
+        self.stalled = 0
+        self.restarts = 0
+        self.cpu = None
+        self.cpu_seconds = 0.0
+
+        # pid -> [process, weakref to the reading source or None, background, started, cpu ticks]
+        self._processes = {}
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()
+        self._loop = None
+        self._watchdog = None
+        self._procfs = os.path.exists('/proc/self/stat')
+
+    def __len__(self):
+        return len(self._processes)
+
+    def thread_args(self):
+        return ['-threads', str(self.threads)] if self.threads else []
+
+    def has_room(self, background: bool = False):
+        limit = self.limit * self.BACKGROUND_SHARE if background else self.limit
+        return len(self._processes) < max(1, limit)
+
+    async def admit(self, *, background: bool = False, loop: asyncio.BaseEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+        self.start(loop)
+
+        deadline = None if background else loop.time() + self.wait
+        while not self.has_room(background):
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, None if deadline is None else max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                raise FFmpegBusy('Too many tracks are playing right now, please try again in a bit.')
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def _wake(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def register(self, process, source=None, *, background: bool = False):
+        # Renice after the fact: a preexec_fn would keep subprocess from using vfork.
+        nice = self.background_nice if background else self.nice
+        if nice and hasattr(os, 'setpriority'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, process.pid, min(19, os.getpriority(os.PRIO_PROCESS, 0) + nice))
+            except OSError:
+                pass
+
+        with self._lock:
+            self._processes[process.pid] = [process, source and weakref.ref(source), background, time.monotonic(), 0]
+        self.spawned += 1
+        metrics.inc('kronos_ffmpeg_spawned_total', kind='background' if background else 'playback')
+
+    async def spawn(self, *args, loop: asyncio.BaseEventLoop = None, **kwargs):
+        """Starts a background FFmpeg job once there's room for it; release() it when it's done."""
+
+        await self.admit(background=True, loop=loop)
+        process = await asyncio.create_subprocess_exec(*args, **kwargs)
+        self.register(process, background=True)
+        return process
+
+    def release(self, process):
+        with self._lock:
+            if self._processes.pop(process.pid, None) is None:
+                return
+
+        # Sources get cleaned up on discord.py's audio threads too.
+        if self._loop is not None and self._waiters:
+            self._loop.call_soon_threadsafe(self._wake)
+
+    def start(self, loop: asyncio.BaseEventLoop):
+        self._loop = loop
+        if self._watchdog is None:
+            self._watchdog = loop.create_task(self.watchdog_task())
+
+    async def watchdog_task(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.check()
+
+    def check(self):
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._processes.values())
+
+        ticks = 0
+        for entry in entries:
+            process, ref, background, started, _ = entry
+            source = ref() if ref is not None else None
+
+            if ref is not None and source is None:
+                # The source went away without cleaning up after itself.
+                self._kill(process)
+                self.release(process)
+                continue
+
+            if background:
+                stalled = now - started > self.background_timeout
+            else:
+                reading_since = getattr(source, 'reading_since', None)
+                stalled = reading_since is not None and now - reading_since > self.stall_timeout
+
+            if stalled and self._kill(process):
+                self.stalled += 1
+                metrics.inc('kronos_ffmpeg_stalled_total', kind='background' if background else 'playback')
+                if source is not None:
+                    source.stalled = True
+
+            if self._procfs:
+                used = self._cpu_ticks(process.pid)
+                if used is not None:
+                    ticks += max(0, used - entry[4])
+                    entry[4] = used
+
+        if self._procfs:
+            seconds = ticks / os.sysconf('SC_CLK_TCK')
+            self.cpu_seconds += seconds
+            self.cpu = seconds / self.interval
+
+    @staticmethod
+    def _kill(process):
+        if process.returncode is not None or (hasattr(process, 'poll') and process.poll() is not None):
+            return False
+        try:
+            process.kill()
+        except ProcessLookupError:
+            return False
+        return True
+
+    @staticmethod
+    def _cpu_ticks(pid: int):
+        try:
+            with open('/proc/{}/stat'.format(pid), 'rb') as f:
+                # The command name can hold spaces, everything after it can't.
+                fields = f.read().rpartition(b')')[2].split()
+        except OSError:
+            return None
+        return int(fields[11]) + int(fields[12])
+
+    def stats(self):
+        with self._lock:
+            background = sum(1 for entry in self._processes.values() if entry[2])
+            running = len(self._processes)
+        return {'running': running, 'background': background, 'limit': self.limit, 'waiting': len(self._waiters),
+                'spawned': self.spawned, 'stalled': self.stalled, 'restarts': self.restarts}
+
+
+class GovernedFFmpeg:
+    """Mixed into discord.py's FFmpeg sources so their processes go through YTDLSource.governor."""
+
+    reading_since = None
+    stalled = False
+
+    def _spawn_process(self, args, **subprocess_kwargs):
+        process = super()._spawn_process(args, **subprocess_kwargs)
+        YTDLSource.governor.register(process, self)
+        return process
+
+    def read(self):
+        # Watched by the governor: a read that never returns is a stalled FFmpeg.
+        self.reading_since = time.monotonic()
+        try:
+            return super().read()
+        finally:
+            self.reading_since = None
+
+    def cleanup(self):
+        process = self._process
+        super().cleanup()
+        if process is not None:
+            YTDLSource.governor.release(process)
+
+
+class GovernedPCMAudio(GovernedFFmpeg, discord.FFmpegPCMAudio):
+    pass
+
+
+class AudioTransform:
+    def process(self, block):
+        """Transforms a (samples, 2) float32 block in place."""
+
+        raise NotImplementedError
+
+
+class Equalizer(AudioTransform):
+    # Gain curves as (frequency, dB) points, interpolated on a log scale.
+    PRESETS = {
+        'bass': ((0, 6), (120, 6), (400, 0), (24000, 0)),
+        'treble': ((0, 0), (2500, 0), (8000, 5), (24000, 5)),
+        'vocal': ((0, -3), (250, -2), (1000, 3), (3500, 3), (8000, -1), (24000, -2)),
+        'night': ((0, 3), (150, 3), (600, 0), (5000, 0), (12000, 2), (24000, 2)),
+    }
+
+    TAPS = 1024
+
+    def __init__(self, preset: str, *, block_size: int):
+        self.preset = preset
+
+        # Linear phase FIR from the preset's magnitude response, applied by
+        # FFT overlap-add so the cost doesn't grow with the filter length.
+        points = numpy.array(self.PRESETS[preset], dtype=numpy.float64)
+        freqs = numpy.fft.rfftfreq(self.TAPS, 1 / 48000)
+        gains_db = numpy.interp(numpy.log10(numpy.maximum(freqs, 1)),
+                                numpy.log10(numpy.maximum(points[:, 0], 1)), points[:, 1])
+        taps = numpy.roll(numpy.fft.irfft(10 ** (gains_db / 20), self.TAPS), self.TAPS // 2)
+        taps *= numpy.hanning(self.TAPS)
+
+        self._nfft = 1 << (block_size + self.TAPS - 1).bit_length()
+        self._response = numpy.fft.rfft(taps, self._nfft)[:, None].astype(numpy.complex64)
+        self._tail = numpy.zeros((self.TAPS - 1, 2), dtype=numpy.float32)
+
+    def process(self, block):
+        count = len(block)
+        filtered = numpy.fft.irfft(numpy.fft.rfft(block, self._nfft, axis=0) * self._response, self._nfft, axis=0)
+
+        filtered[:self.TAPS - 1] += self._tail
+        self._tail[:] = filtered[count:count + self.TAPS - 1]
+        block[:] = filtered[:count]
+
+
+class Normalizer(AudioTransform):
+    def __init__(self, *, target: float = 0.1, max_gain: float = 4.0, ramp):
+        self.target = target
+        self.max_gain = max_gain
+        self.gain = 1.0
+        self._ramp = ramp
+
+    def process(self, block):
+        flat = block.reshape(-1)
+        rms = math.sqrt(float(numpy.dot(flat, flat)) / max(len(flat), 1))
+        if rms < 1e-4:
+            return  # Silence, don't pump the gain up.
+
+        desired = min(self.max_gain, max(1 / self.max_gain, self.target / rms))
+        # Duck fast, recover slowly.
+        rate = 0.5 if desired < self.gain else 0.05
+        gain = self.gain + (desired - self.gain) * rate
+
+        self._ramp(block, self.gain, gain)
+        self.gain = gain
+
+
+class AudioPipeline:
+    """Batched NumPy processing of an FFmpeg PCM stream.
+
+    Frames are read straight into preallocated buffers a batch at a time and
+    transformed in place; the only per-frame allocation left is the bytes
+    object handed to the Opus encoder.
+    """
+
+    BATCH_FRAMES = 5
+    RAMP_SAMPLES = 2400  # 50 ms
+
+    def __init__(self, original: discord.FFmpegPCMAudio, *, volume: float = 0.5, eq: str = None, normalize: bool = False):
+        self.original = original
+        self.volume = volume
+        self._gain = volume
+
+        samples = self.BATCH_FRAMES * discord.opus.Encoder.SAMPLES_PER_FRAME
+        self._raw = bytearray(samples * 4)
+        self._out = bytearray(samples * 4)
+        self._work = numpy.zeros((samples, 2), dtype=numpy.float32)
+        self._scratch = numpy.zeros(self.RAMP_SAMPLES, dtype=numpy.float32)
+        self._unit = numpy.linspace(0, 1, self.RAMP_SAMPLES, dtype=numpy.float32)
+
+        self.transforms = []
+        if eq:
+            self.transforms.append(Equalizer(eq, block_size=samples))
+        if normalize:
+            self.transforms.append(Normalizer(ramp=self.ramp))
+
+        self._pending = b''
+        self._offset = 0
+
+    def ramp(self, block, start: float, end: float):
+        """Scales a block by a gain moving linearly from start to end, so gain changes don't click."""
+
+        if start == end:
+            if end != 1.0:
+                block *= end
+            return
+
+        count = min(len(block), self.RAMP_SAMPLES)
+        gains = self._scratch[:count]
+        numpy.multiply(self._unit[:count], end - start, out=gains)
+        gains += start
+
+        block[:count] *= gains[:, None]
+        block[count:] *= end
+
+    def read(self):
+        if self._offset >= len(self._pending) and not self._fill():
+            return b''
+
+        frame = self._pending[self._offset:self._offset + discord.opus.Encoder.FRAME_SIZE]
+        self._offset += len(frame)
+        return frame
+
+    def _fill(self):
+        view = memoryview(self._raw)
+        size = 0
+        # This reads FFmpeg's pipe directly, so it marks the read for the
+        # governor's stall watchdog the way GovernedFFmpeg.read does.
+        self.original.reading_since = time.monotonic()
+        try:
+            while size < len(view):
+                read = self.original._stdout.readinto(view[size:])
+                if not read:
+                    break
+                size += read
+        finally:
+            self.original.reading_since = None
+
+        # Like FFmpegPCMAudio, a trailing partial frame is dropped.
+        size -= size % discord.opus.Encoder.FRAME_SIZE
+        if not size:
+            return False
+
+        count = size // 4
+        block = self._work[:count]
+        numpy.multiply(numpy.frombuffer(self._raw, dtype=numpy.int16, count=count * 2).reshape(-1, 2),
+                       1 / 32768, out=block, casting='unsafe')
+
+        for transform in self.transforms:
+            transform.process(block)
+
+        self.ramp(block, self._gain, self.volume)
+        self._gain = self.volume
+
+        numpy.clip(block, -1, 1, out=block)
+        block *= 32767
+        out = numpy.frombuffer(self._out, dtype=numpy.int16, count=count * 2).reshape(-1, 2)
+        numpy.copyto(out, block, casting='unsafe')
+
+        self._pending = bytes(memoryview(self._out)[:size])
+        self._offset = 0
+        return True
+
+
+class SharedStream:
+    """One FFmpeg Opus pipeline whose packets are kept in a ring buffer for several readers.
+
+    There's no producer thread: whichever reader is furthest ahead pulls the
+    next packet from FFmpeg, the others find it in the ring.
+    """
+
+    def __init__(self, key, upstream: discord.AudioSource, capacity: int):
+        self.key = key
+        self.upstream = upstream
+        self.created_at = time.monotonic()
+        self.readers = 0
+        self.finished = False
+        self.stalled = False
+
+        self._ring = [None] * capacity
+        self._produced = 0
+        self._lock = threading.Lock()
+
+    def packet(self, index: int):
+        """Packet `index` of the stream, b'' past the end, None if it already left the ring."""
+
+        with self._lock:
+            if index < self._produced - len(self._ring):
+                return None
+
+            while index >= self._produced:
+                if self.finished:
+                    return b''
+
+                data = self.upstream.read()
+                if not data:
+                    self.finished = True
+                    self.stalled = self.upstream.stalled
+                    return b''
+
+                self._ring[self._produced % len(self._ring)] = data
+                self._produced += 1
+
+            return self._ring[index % len(self._ring)]
+
+    def close(self):
+        with self._lock:
+            self.finished = True
+            self._ring = [None] * len(self._ring)
+        self.upstream.cleanup()
+
+
+class StreamHub:
+    """Lets guilds that start the same track at the same volume within `window` seconds share one FFmpeg.
+
+    Each guild reads through its own cursor, so pausing, skipping or looping
+    stays per guild. A guild that falls more than `buffer` seconds behind the
+    fastest one (a long pause) continues on a private FFmpeg from where it was.
+    """
+
+    def __init__(self, *, window: float = 10, buffer: float = 60, enabled: bool = True):
+        self.window = window
+        self.capacity = int(buffer * 50)
+        self.enabled = enabled
+        self.fallbacks = 0
+
+        self._streams = {}
+        # Readers detach from discord.py's audio threads too.
+        self._lock = threading.Lock()
+
+    def attach(self, song: 'Song', *, volume: float, path: str = None):
+        gain = YTDLSource.loudness.factor(song.track.id)
+        key = (song.track.id, round(volume * gain, 3))
+
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None or stream.finished or time.monotonic() - stream.created_at > self.window:
+                stream = None
+            else:
+                stream.readers += 1
+
+        if stream is None:
+            stream = SharedStream(key, OpusSource(song, volume=volume, gain=gain, path=path), self.capacity)
+            stream.readers = 1
+            with self._lock:
+                # Whatever was there before keeps running for its readers,
+                # it just can't be joined anymore.
+                self._streams[key] = stream
+
+        return SharedSource(song, stream, self, volume=volume, gain=gain, path=path)
+
+    def detach(self, stream: SharedStream):
+        with self._lock:
+            stream.readers -= 1
+            if stream.readers:
+                return
+            if self._streams.get(stream.key) is stream:
+                del self._streams[stream.key]
+
+        stream.close()
+
+    def stats(self):
+        with self._lock:
+            streams = list(self._streams.values())
+        return {'streams': len(streams), 'readers': sum(stream.readers for stream in streams),
+                'fallbacks': self.fallbacks}
+
+
+class SharedSource(discord.AudioSource):
+    def __init__(self, song: 'Song', shared: SharedStream, hub: StreamHub, *, volume: float, gain: float,
+                 path: str = None):
+        self.song = song
+        self.stream = song.stream
+        self.volume = volume
+        self.eq = None
+        self.gain = gain
+        # Looked up on the event loop: the cache isn't touched from the audio thread.
+        self.path = path
+        self.frames = 0
+        self.clock = FrameClock()
+
+        self._shared = shared
+        self._hub = hub
+        self._private = None
+        self.stalled = False
+
+    def __str__(self):
+        return str(self.song)
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        if self._private is None:
+            packet = self._shared.packet(self.frames)
+            if packet is None:
+                # Paused for longer than the ring holds: go on alone.
+                if not YTDLSource.governor.has_room():
+                    # No waiting on the audio thread: end here as stalled, the
+                    # player restarts the song from this position once admitted.
+                    self.stalled = True
+                    return b''
+
+                self._private = OpusSource(self.song, volume=self.volume, gain=self.gain, start=self.position,
+                                           path=self.path)
+                self._hub.fallbacks += 1
+                self._detach()
+
+        if self._private is not None:
+            packet = self._private.read()
+
+        if packet:
+            self.frames += 1
+            self.clock.tick()
+        else:
+            self.stalled = self.stalled or getattr(self._private or self._shared, 'stalled', False)
+        return packet
+
+    def _detach(self):
+        if self._shared is not None:
+            shared, self._shared = self._shared, None
+            self._hub.detach(shared)
+
+    def cleanup(self):
+        self.clock.flush()
+        self._detach()
+        if self._private is not None:
+            self._private.cleanup()
+
+    @property
+    def position(self):
+        return self.frames * 0.02
+
+
+class YTDLSource(discord.AudioSource):
+    YTDL_OPTIONS = {
+        # Prefer Opus (WebM) so the opus engine can pass packets straight through.
+        'format': 'bestaudio[acodec=opus]/bestaudio/best',
+        'extractaudio': True,
+        'audioformat': 'mp3',
+        'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
+        'restrictfilenames': True,
+        'noplaylist': True,
+        'nocheckcertificate': True,
+        'ignoreerrors': False,
+        'logtostderr': False,
+        'quiet': True,
+        'no_warnings': True,
+        'source_address': '0.0.0.0',
+    }
+
+    FFMPEG_OPTIONS = {
+        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+        'options': '-vn',
+    }
+
+    # Search strings resolve to the same video for a long time, but the
+    # signed stream URLs handed out by YouTube expire after a few hours.
+    METADATA_TTL = int(os.environ.get('KRONOS_METADATA_TTL', 6 * 60 * 60))
+    STREAM_TTL = int(os.environ.get('KRONOS_STREAM_TTL', 30 * 60))
+    STREAM_EXPIRY_MARGIN = 5 * 60
+
+    PLAYLIST_LIMIT = int(os.environ.get('KRONOS_PLAYLIST_LIMIT', 500))
+    # YouTube lists playlists 100 videos to a page: that many get queued
+    # right away, the rest follow in the background.
+    PLAYLIST_PAGE = 100
+
+    # 'opus' hands Opus packets to discord.py as-is (or has FFmpeg encode
+    # them), 'pcm' decodes to PCM and scales/encodes every frame in Python.
+    # Equalizer presets and normalization always need the PCM path.
+    ENGINE = os.environ.get('KRONOS_PLAYBACK_ENGINE', 'opus')
+    OPUS_BITRATE = int(os.environ.get('KRONOS_OPUS_BITRATE', 128))
+    NORMALIZE = os.environ.get('KRONOS_NORMALIZE') == '1'
+
+    hub = StreamHub(window=float(os.environ.get('KRONOS_SHARED_WINDOW', 10)),
+                    buffer=float(os.environ.get('KRONOS_SHARED_BUFFER_SECONDS', 60)),
+                    enabled=os.environ.get('KRONOS_SHARED_STREAMS', '1') == '1')
+
+    cache = AudioCache(os.environ.get('KRONOS_AUDIO_CACHE_DIR'),
+                       max_bytes=int(os.environ.get('KRONOS_AUDIO_CACHE_MB', 1024)) * 1024 * 1024,
+                       max_length=int(os.environ.get('KRONOS_AUDIO_CACHE_MAX_LENGTH', 900)))
+
+    # Loudness matching is opt-in: its gain goes into the FFmpeg volume
+    # filter, so a measured track never gets opus passthrough, even at 100%.
+    loudness = LoudnessIndex(os.environ.get('KRONOS_LOUDNESS_DB', 'kronos_loudness.db'),
+                             target=float(os.environ.get('KRONOS_LOUDNESS_TARGET', -14)),
+                             enabled=os.environ.get('KRONOS_LOUDNESS') == '1')
+
+    # youtube_dl is imported on the first extraction (or in the background
+    # after on_ready) rather than at import, and only youtube.py out of its
+    # extractor modules is loaded (~0.08s instead of ~0.3s for all of them).
+    # Only these extractors are registered.
+    EXTRACTORS = os.environ.get('KRONOS_EXTRACTORS',
+                                'Youtube,YoutubeYtBe,YoutubeTab,YoutubePlaylist,YoutubeSearch').split(',')
+
+    ytdl = None
+    _ytdl_lock = threading.Lock()
+
+    http = ConnectionPool(per_host=int(os.environ.get('KRONOS_HTTP_PER_HOST', 4)),
+                          host_limits=ConnectionPool.parse_limits(os.environ.get('KRONOS_HTTP_HOST_LIMITS')),
+                          idle_timeout=float(os.environ.get('KRONOS_HTTP_IDLE_TIMEOUT', 60)))
+
+    # Signature functions are cached on disk per player version, so they
+    # stay valid across restarts and are shared by extractor processes;
+    # only versions older than this get dropped. 0 wipes them on start.
+    PLAYER_CACHE_TTL = float(os.environ.get('KRONOS_PLAYER_CACHE_TTL', 7 * 24 * 60 * 60))
+
+    governor = FFmpegGovernor(limit=int(os.environ.get('KRONOS_FFMPEG_MAX', 32 * (os.cpu_count() or 1))),
+                              threads=int(os.environ.get('KRONOS_FFMPEG_THREADS', 1)),
+                              nice=int(os.environ.get('KRONOS_FFMPEG_NICE', 5)),
+                              background_nice=int(os.environ.get('KRONOS_FFMPEG_BACKGROUND_NICE', 15)),
+                              stall_timeout=float(os.environ.get('KRONOS_FFMPEG_STALL_TIMEOUT', 20)),
+                              background_timeout=float(os.environ.get('KRONOS_FFMPEG_BACKGROUND_TIMEOUT', 600)),
+                              wait=float(os.environ.get('KRONOS_FFMPEG_WAIT', 10)))
+
+    history = TrackHistory(os.environ.get('KRONOS_HISTORY_DB', 'kronos_history.db'),
+                           threshold=float(os.environ.get('KRONOS_HISTORY_MATCH', 0.9)),
+                           similarity=float(os.environ.get('KRONOS_HISTORY_SIMILARITY', 0.6)),
+                           enabled=os.environ.get('KRONOS_HISTORY', '1') == '1')
+
+    search_cache = ResolutionCache(maxsize=int(os.environ.get('KRONOS_SEARCH_CACHE_SIZE', 4096)), ttl=METADATA_TTL)
+    info_cache = ResolutionCache(maxsize=int(os.environ.get('KRONOS_INFO_CACHE_SIZE', 1024)), ttl=STREAM_TTL)
+
+    pool = ExtractorPool(max_workers=int(os.environ.get('KRONOS_EXTRACTOR_WORKERS', 4)),
+                         use_processes=os.environ.get('KRONOS_EXTRACTOR_PROCESSES') == '1',
+                         max_pending=int(os.environ.get('KRONOS_EXTRACTOR_MAX_PENDING', 64)),
+                         max_pending_per_guild=int(os.environ.get('KRONOS_EXTRACTOR_MAX_PENDING_PER_GUILD', 4)))
+
+    def __init__(self, song: 'Song', *, volume: float = 0.5, start: float = 0, eq: str = None, path: str = None):
+        # Only built right before playback, so FFmpeg processes exist for
+        # songs that are playing (or about to), never for the whole queue.
+        self.original = GovernedPCMAudio(path or song.stream.url, **self.ffmpeg_options(start, local=bool(path)))
+
+        self.song = song
+        self.stream = song.stream
+        self.eq = eq
+        self.gain = self.loudness.factor(song.track.id)
+        self.frames = int(start * 50)
+        self.clock = FrameClock()
+        self._volume = volume
+
+        if numpy is not None:
+            self.pipeline = AudioPipeline(self.original, volume=volume * self.gain, eq=eq, normalize=self.NORMALIZE)
+        else:
+            self.pipeline = None
+
+    def __str__(self):
+        return str(self.song)
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._volume = value
+
+        if self.pipeline is not None:
+            self.pipeline.volume = value * self.gain
+
+    @property
+    def stalled(self):
+        return self.original.stalled
+
+    def read(self):
+        self.frames += 1
+        self.clock.tick()
+
+        if self.pipeline is not None:
+            return self.pipeline.read()
+
+        return audioop.mul(self.original.read(), 2, min(self._volume * self.gain, 2.0))
+
+    def cleanup(self):
+        self.clock.flush()
+        self.original.cleanup()
+
+    @property
+    def position(self):
+        return self.frames * 0.02
+
+    @classmethod
+    def extractor(cls):
+        if cls.ytdl is None:
+            with cls._ytdl_lock:
+                if cls.ytdl is None:
+                    started = time.perf_counter()
+
+                    if 'youtube_dl' not in sys.modules:
+                        # youtube_dl.extractor imports all ~800 extractor modules
+                        # unless a generated lazy_extractors module exists. An
+                        # empty one stands in for it, so only youtube.py and
+                        # what it needs get imported below.
+                        lazy = types.ModuleType('youtube_dl.extractor.lazy_extractors')
+                        lazy._ALL_CLASSES = []
+                        sys.modules[lazy.__name__] = lazy
+
+                    import youtube_dl
+                    from youtube_dl.extractor import youtube
+
+                    # Silence useless bug reports messages
+                    youtube_dl.utils.bug_reports_message = lambda: ''
+
+                    ytdl = youtube_dl.YoutubeDL(cls.YTDL_OPTIONS, auto_init=False)
+                    for name in cls.EXTRACTORS:
+                        extractor = getattr(youtube, name.strip() + 'IE', None)
+                        if extractor is None:
+                            # Anything outside youtube.py needs the full list.
+                            from youtube_dl.extractor import extractors
+                            extractor = getattr(extractors, name.strip() + 'IE')
+                        ytdl.add_info_extractor(extractor())
+                    cls.http.install(ytdl)
+                    cls.prune_player_cache(ytdl.cache)
+
+                    cls.ytdl = ytdl
+                    startup.mark('extractor', time.perf_counter() - started)
+
+        return cls.ytdl
+
+    @classmethod
+    def prune_player_cache(cls, cache):
+        if not cls.PLAYER_CACHE_TTL:
+            cache.remove()
+            return
+
+        directory = os.path.join(cache._get_root_dir(), 'youtube-sigfuncs')
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+
+        cutoff = time.time() - cls.PLAYER_CACHE_TTL
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    @classmethod
+    def open(cls, song: 'Song', *, volume: float = 0.5, start: float = 0, eq: str = None):
+        started = time.perf_counter()
+
+        path = cls.cache.path(song.track.id)
+
+        if cls.ENGINE == 'opus' and not eq and not cls.NORMALIZE:
+            if path and volume * cls.loudness.factor(song.track.id) == 1.0:
+                source = CachedOpusSource(song, path, volume=volume, start=start)
+            elif cls.hub.enabled and not start and song.track.id:
+                # Reading a cached file from a memory map is already cheap;
+                # live streams are worth sharing between guilds.
+                source = cls.hub.attach(song, volume=volume, path=path)
+            else:
+                source = OpusSource(song, volume=volume, start=start, path=path)
+        else:
+            source = cls(song, volume=volume, start=start, eq=eq, path=path)
+
+        metrics.observe('kronos_stage_seconds', time.perf_counter() - started, stage='ffmpeg_spawn')
+        return source
+
+    @classmethod
+    def ffmpeg_options(cls, start: float = 0, filters: str = None, local: bool = False):
+        # The reconnect flags only make sense for (and are only accepted by) HTTP inputs.
+        before_options = '' if local else cls.FFMPEG_OPTIONS['before_options']
+        options = cls.FFMPEG_OPTIONS['options']
+
+        threads = ' '.join(cls.governor.thread_args())
+        if threads:
+            before_options = '{} {}'.format(threads, before_options).strip()
+            options = '{} {}'.format(threads, options)
+
+        if start:
+            before_options = '-ss {:.2f} {}'.format(start, before_options)
+        if filters:
+            options = '{} -filter:a {}'.format(options, filters)
+
+        return {'before_options': before_options, 'options': options}
+
+    @classmethod
+    async def resolve(cls, search: str, *, key=None, loop: asyncio.BaseEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+
+        search_key = cls.normalize_search(search)
+        resolved = cls.search_cache.get(search_key)
+
+        if resolved is None:
+            # Anything played here before skips the search request altogether.
+            track = await cls.history.match_async(search, loop=loop)
+            if track is not None:
+                metrics.inc('kronos_history_lookups_total', result='hit')
+                return await cls.resolve_track(track, search, key=key, loop=loop)
+
+            metrics.inc('kronos_history_lookups_total', result='miss')
+            started = time.perf_counter()
+            webpage_url = await cls.pool.submit(key, extract_webpage_url, search, loop=loop)
+            metrics.observe('kronos_stage_seconds', time.perf_counter() - started, stage='search')
+            if webpage_url is None:
+                raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+
+            track, stream = await cls.process_url(webpage_url, key=key, loop=loop)
+            cls.remember(track, stream, search)
+        else:
+            video_id, webpage_url = resolved
+            cached = cls.info_cache.get(video_id)
+            if cached is None:
+                track, stream = await cls.process_url(webpage_url, key=key, loop=loop)
+            else:
+                track, stream = cached
+
+        return track, stream
+
+    @classmethod
+    async def resolve_track(cls, track: Track, *searches: str, key=None, queued: bool = False,
+                            loop: asyncio.BaseEventLoop = None):
+        """Like resolve(), for a video that is already known: no search request."""
+
+        resolved = cls.info_cache.get(track.id)
+        if resolved is None:
+            resolved = await cls.process_url(track.url, key=key, queued=queued, loop=loop)
+
+        cls.remember(*resolved, *searches)
+        return resolved
+
+    @classmethod
+    async def candidates(cls, search: str, *, limit: int = 5, key=None, loop: asyncio.BaseEventLoop = None):
+        """Local and remote matches for `search`, without processing any of them."""
+
+        loop = loop or asyncio.get_event_loop()
+
+        started = time.perf_counter()
+        local, remote = await asyncio.gather(cls.history.search_async(search, limit, loop=loop),
+                                             cls.pool.submit(key, extract_candidates, search, limit, loop=loop))
+        metrics.observe('kronos_stage_seconds', time.perf_counter() - started, stage='search')
+
+        local = [track for track, score in local]
+        seen = {track.id for track in local}
+        return local, [track for track in remote if track.id not in seen]
+
+    @classmethod
+    async def create_playlist(cls, ctx: commands.Context, playlist_url: str, *, start: int = 0, limit: int = None,
+                              loop: asyncio.BaseEventLoop = None):
+        """Title and (url, title) entries of a playlist, from entry `start` up to entry `limit`."""
+
+        loop = loop or asyncio.get_event_loop()
+
+        # Past the first page, the playlist was already accepted: don't turn it away.
+        data = await cls.pool.submit(ctx.guild.id, extract_playlist, playlist_url, limit or cls.PLAYLIST_LIMIT, start,
+                                     queued=bool(start), loop=loop)
+        if data is None or (not data[1] and not start):
+            raise YTDLError('Couldn\'t find any tracks in `{}`'.format(playlist_url))
+
+        return data
+
+    @staticmethod
+    def playlist_url(search: str):
+        url = urllib.parse.urlparse(search.strip())
+        if not url.netloc.endswith(('youtube.com', 'youtu.be')):
+            return None
+
+        query = urllib.parse.parse_qs(url.query)
+        playlist_id = query.get('list')
+        if not playlist_id or playlist_id[0].startswith('RD'):
+            # RD lists are generated mixes that never end.
+            return None
+
+        if 'v' in query or (url.netloc.endswith('youtu.be') and url.path.strip('/')):
+            # A video opened from a playlist: whoever pasted it wants that video.
+            return None
+
+        return 'https://www.youtube.com/playlist?list={}'.format(playlist_id[0])
+
+    @classmethod
+    async def process_url(cls, webpage_url: str, *, key=None, queued: bool = False,
+                          loop: asyncio.BaseEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+
+        started = time.perf_counter()
+        resolved = await cls.pool.submit(key, extract_track, webpage_url, queued=queued, loop=loop)
+        metrics.observe('kronos_stage_seconds', time.perf_counter() - started, stage='process')
+        if resolved is None:
+            raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
+
+        cls.remember(*resolved, webpage_url)
+        return resolved
+
+    @classmethod
+    def remember(cls, track: Track, stream: Stream, *searches: str):
+        """Caches a resolved track under its video id and every search that led to it."""
+
+        resolved = (track.id, track.url)
+        for search in (track.url,) + searches:
+            if search:
+                cls.search_cache.put(cls.normalize_search(search), resolved)
+
+        cls.info_cache.put(track.id, (track, stream), ttl=cls.stream_ttl(stream.url))
+        cls.history.record(track, searches)
+
+    @classmethod
+    def stream_ttl(cls, stream_url: str):
+        # Signed googlevideo URLs carry their own expiry timestamp; never
+        # keep them around for longer than that.
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(stream_url or '').query)
+        try:
+            expires = int(query['expire'][0])
+        except (KeyError, IndexError, ValueError):
+            return cls.STREAM_TTL
+
+        return max(0, min(cls.STREAM_TTL, expires - time.time() - cls.STREAM_EXPIRY_MARGIN))
+
+    @staticmethod
+    def normalize_search(search: str):
+        search = search.strip()
+        if '://' in search:
+            return search
+
+        return ' '.join(search.casefold().split())
+
+    @staticmethod
+    def parse_duration(duration: int):
+        minutes, seconds = divmod(duration, 60)
+        hours, minutes = divmod(minutes, 60)
+        days, hours = divmod(hours, 24)
+
+        duration = []
+        if days > 0:
+            duration.append('{} days'.format(days))
+        if hours > 0:
+            duration.append('{} hours'.format(hours))
+        if minutes > 0:
+            duration.append('{} minutes'.format(minutes))
+        if seconds > 0:
+            duration.append('{} seconds'.format(seconds))
+
+        return ', '.join(duration)
+
+
+class OpusSource(GovernedFFmpeg, discord.FFmpegOpusAudio):
+    def __init__(self, song: 'Song', *, volume: float = 0.5, gain: float = None, start: float = 0, path: str = None):
+        # Sources built on the audio thread are handed the gain, the
+        # loudness index is only read on the event loop.
+        self.gain = YTDLSource.loudness.factor(song.track.id) if gain is None else gain
+        codec = 'opus' if path else song.stream.codec
+        # Set before FFmpeg is spawned: cleanup() runs even if that fails.
+        self.frames = int(start * 50)
+        self.clock = FrameClock()
+
+        if volume * self.gain == 1.0 and codec == 'opus':
+            # Nothing to change about the audio: remux the Opus packets
+            # without decoding or re-encoding them anywhere.
+            super().__init__(path or song.stream.url, codec='copy',
+                             **YTDLSource.ffmpeg_options(start, local=bool(path)))
+        else:
+            # FFmpeg applies the volume and encodes, Python never sees PCM.
+            super().__init__(path or song.stream.url, bitrate=YTDLSource.OPUS_BITRATE,
+                             **YTDLSource.ffmpeg_options(start, 'volume={:.3f}'.format(volume * self.gain),
+                                                         local=bool(path)))
+
+        self.song = song
+        self.stream = song.stream
+        self.volume = volume
+        self.eq = None
+
+    def __str__(self):
+        return str(self.song)
+
+    def read(self):
+        self.frames += 1
+        self.clock.tick()
+        return super().read()
+
+    def cleanup(self):
+        self.clock.flush()
+        super().cleanup()
+
+    @property
+    def position(self):
+        return self.frames * 0.02
+
+
+class CachedOpusSource(discord.AudioSource):
+    """Sends the packets of a cached Ogg/Opus file from a memory map, no FFmpeg involved."""
+
+    stalled = False
+
+    def __init__(self, song: 'Song', path: str, *, volume: float = 1.0, start: float = 0):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        packets = discord.oggparse.OggStream(self._map).iter_packets()
+        head = next(packets, b'')
+        if head.startswith(b'OpusHead'):
+            next(packets, None)  # OpusTags
+        else:
+            packets = itertools.chain((head,), packets)
+
+        # Every packet is a 20 ms frame, so seeking is skipping packets.
+        self._packets = itertools.islice(packets, int(start * 50), None)
+
+        self.song = song
+        self.stream = song.stream
+        self.volume = volume
+        self.eq = None
+        self.gain = 1.0
+        self.frames = int(start * 50)
+        self.clock = FrameClock()
+
+    def __str__(self):
+        return str(self.song)
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        packet = next(self._packets, b'')
+        if packet:
+            self.frames += 1
+            self.clock.tick()
+        return packet
+
+    def cleanup(self):
+        self.clock.flush()
+        if self._map is not None:
+            self._packets = iter(())
+            self._map.close()
+            self._map = None
+
+    @property
+    def position(self):
+        return self.frames * 0.02
+
+
+def ffmpeg_running(source: discord.AudioSource):
+    process = getattr(source, '_process', None) or getattr(getattr(source, 'original', None), '_process', None)
+    return process is not None and process.poll() is None
+
+
+class Song:
+    __slots__ = ('track', 'requester', 'channel', 'stream', 'expires_at', 'start', 'source')
+
+    def __init__(self, requester: discord.Member, channel: discord.TextChannel, track: Track, stream: Stream = None):
+        self.track = track
+        self.requester = requester
+        self.channel = channel
+
+        # Playlist entries (and restored queues) start out without a stream
+        # URL; they get resolved right before playing.
+        self.stream = None
+        self.expires_at = 0
+        self.start = 0
+        self.source = None
+
+        if stream is not None:
+            self.update(track, stream)
+
+    def __str__(self):
+        return '**{0.title}** by **{0.uploader}**'.format(self.track)
+
+    @classmethod
+    async def create(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):
+        track, stream = await YTDLSource.resolve(search, key=ctx.guild.id, loop=loop)
+        return cls(ctx.author, ctx.channel, track, stream)
+
+    @classmethod
+    def from_payload(cls, payload: list, ctx: commands.Context):
+        *track, requester_id, channel_id = payload
+
+        # Whoever brought the guild back gets credit for songs whose
+        # requester or channel can't be found anymore.
+        requester = ctx.guild.get_member(requester_id) or ctx.bot.get_user(requester_id) or ctx.author
+        channel = ctx.bot.get_channel(channel_id) or ctx.channel
+        return cls(requester, channel, Track(*track))
+
+    def payload(self):
+        return list(self.track) + [self.requester.id, self.channel.id]
+
+    @property
+    def title(self):
+        return self.track.title
+
+    @property
+    def url(self):
+        return self.track.url
+
+    @property
+    def length(self):
+        return self.track.length
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def update(self, track: Track, stream: Stream):
+        self.track = track
+        self.stream = stream
+        self.expires_at = time.monotonic() + YTDLSource.stream_ttl(stream.url)
+
+    async def prefetch(self, *, loop: asyncio.BaseEventLoop = None):
+        # Only refreshes metadata and the stream URL, FFmpeg is left for warm().
+        if self.expired:
+            # The video is already known, so there's nothing to search for.
+            self.update(*await YTDLSource.resolve_track(self.track, key=self.channel.guild.id, queued=True,
+                                                        loop=loop))
+
+    async def warm(self, *, volume: float = 0.5, eq: str = None, loop: asyncio.BaseEventLoop = None):
+        await self.prefetch(loop=loop)
+
+        if self.source is None or self.source.stream != self.stream:
+            self.release()
+            await YTDLSource.governor.admit(loop=loop)
+            self.source = YTDLSource.open(self, volume=volume, eq=eq, start=self.start)
+            self.start = 0
+        elif self.source.volume != volume or self.source.eq != eq:
+            self.retune(volume, eq)
+
+        return self.source
+
+    def retune(self, volume: float, eq: str = None, voice: discord.VoiceClient = None):
+        if self.source is None:
+            return
+
+        if not self.source.is_opus() and self.source.eq == eq:
+            # The PCM pipeline ramps to the new volume on its own.
+            self.source.volume = volume
+            return
+
+        # The volume is baked into the FFmpeg output, so pick the stream
+        # back up where it is with the new settings and swap it in.
+        old = self.source
+        self.source = YTDLSource.open(self, volume=volume, eq=eq, start=old.position)
+        if voice is not None and voice.source is old:
+            voice.source = self.source
+
+        old.cleanup()
+
+    def release(self):
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
+
+    def create_embed(self):
+        embed = (discord.Embed(title='Now playing',
+                               description='```css\n{0.title}\n```'.format(self.track),
+                               color=discord.Color.blurple())
+                 .add_field(name='Duration', value=self.track.duration)
+                 .add_field(name='Requested by', value=self.requester.mention)
+                 .add_field(name='Uploader', value='[{0.uploader}]({0.uploader_url})'.format(self.track))
+                 .add_field(name='URL', value='[Click]({0.url})'.format(self.track))
+                 .set_thumbnail(url=self.track.thumbnail))
+
+        return embed
+
+
+class BlockList:
+    """A sequence stored as a list of blocks of up to 2 * BLOCK items.
+
+    Indexing bisects the block start offsets, so it's O(log n); inserting or
+    deleting only shifts items within one block. Offsets are recomputed
+    lazily, once per batch of changes, and popping from the front (what the
+    player does) doesn't invalidate them at all.
+    """
+
+    BLOCK = 256
+
+    def __init__(self, items=()):
+        self._blocks = []
+        self._offsets = []
+        self._shift = 0
+        self._len = 0
+        self._dirty = False
+        self.extend(items)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks)
+
+    def _reindex(self):
+        if self._dirty:
+            self._offsets = list(itertools.accumulate((len(block) for block in self._blocks[:-1]), initial=0))
+            self._shift = 0
+            self._dirty = False
+
+    def _locate(self, index: int):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('queue index out of range')
+
+        self._reindex()
+        index += self._shift
+        b = bisect.bisect_right(self._offsets, index) - 1
+        return b, index - self._offsets[b]
+
+    def _new_block(self, block: list):
+        if not self._dirty:
+            self._offsets.append(self._len + self._shift)
+        self._blocks.append(block)
+
+    def append(self, item):
+        if self._blocks and len(self._blocks[-1]) < self.BLOCK:
+            self._blocks[-1].append(item)
+        else:
+            self._new_block([item])
+        self._len += 1
+
+    def extend(self, items):
+        items = list(items)
+        if self._blocks and items:
+            room = self.BLOCK - len(self._blocks[-1])
+            if room > 0:
+                self._blocks[-1].extend(items[:room])
+                self._len += len(items[:room])
+                items = items[room:]
+
+        for i in range(0, len(items), self.BLOCK):
+            block = items[i:i + self.BLOCK]
+            self._new_block(block)
+            self._len += len(block)
+
+    def popleft(self):
+        if not self._len:
+            raise IndexError('pop from an empty queue')
+
+        block = self._blocks[0]
+        item = block.pop(0)
+        self._len -= 1
+        self._shift += 1
+
+        if not block:
+            del self._blocks[0]
+            if not self._dirty:
+                del self._offsets[0]
+        elif not self._dirty:
+            self._offsets[0] += 1
+        return item
+
+    def pop(self, index: int = -1):
+        b, i = self._locate(index)
+        item = self._blocks[b].pop(i)
+        self._removed(b, 1)
+        return item
+
+    def insert(self, index: int, item):
+        if index >= self._len or not self._blocks:
+            return self.append(item)
+
+        b, i = self._locate(max(index, -self._len))
+        block = self._blocks[b]
+        block.insert(i, item)
+        self._len += 1
+        self._dirty = True
+
+        if len(block) > 2 * self.BLOCK:
+            self._blocks[b:b + 1] = [block[:self.BLOCK], block[self.BLOCK:]]
+
+    def _removed(self, b: int, count: int):
+        self._len -= count
+        self._dirty = True
+        if not self._blocks[b]:
+            del self._blocks[b]
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            b, i = self._locate(item)
+            return self._blocks[b][i]
+
+        start, stop, step = item.indices(self._len)
+        if step != 1:
+            return list(self)[item]
+        if start >= stop:
+            return []
+
+        # Only walks the blocks the page actually covers.
+        b, i = self._locate(start)
+        result = []
+        while len(result) < stop - start:
+            result.extend(self._blocks[b][i:i + stop - start - len(result)])
+            b, i = b + 1, 0
+        return result
+
+    def __delitem__(self, item):
+        if not isinstance(item, slice):
+            b, i = self._locate(item)
+            del self._blocks[b][i]
+            return self._removed(b, 1)
+
+        start, stop, step = item.indices(self._len)
+        if step != 1:
+            items = list(self)
+            del items[item]
+            return self.rebuild(items)
+        if start >= stop:
+            return
+
+        first, i = self._locate(start)
+        last, j = self._locate(stop - 1)
+        if first == last:
+            del self._blocks[first][i:j + 1]
+        else:
+            del self._blocks[last][:j + 1]
+            del self._blocks[first][i:]
+            del self._blocks[first + 1:last]
+
+        self._len -= stop - start
+        self._dirty = True
+        self._blocks[first:first + 2] = [block for block in self._blocks[first:first + 2] if block]
+
+    def clear(self):
+        self.rebuild(())
+
+    def rebuild(self, items):
+        """Replaces the contents wholesale, for operations that touch every item anyway."""
+
+        self._blocks = []
+        self._offsets = []
+        self._shift = 0
+        self._len = 0
+        self._dirty = False
+        self.extend(items)
+
+
+class SongQueue(asyncio.Queue):
+    def __init__(self, *, on_change=None):
+        super().__init__()
+        self.on_change = on_change
+
+    def _init(self, maxsize):
+        self._queue = BlockList()
+
+    def _put(self, item):
+        super()._put(item)
+        self._changed()
+
+    def _get(self):
+        item = super()._get()
+        self._changed()
+        return item
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def __getitem__(self, item):
+        return self._queue[item]
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def __len__(self):
+        return self.qsize()
+
+    def extend(self, items):
+        """Enqueues many songs at once, waking the player a single time."""
+
+        before = len(self._queue)
+        self._queue.extend(items)
+        added = len(self._queue) - before
+        if not added:
+            return
+
+        self._unfinished_tasks += added
+        self._finished.clear()
+        self._wakeup_next(self._getters)
+        self._changed()
+
+    def clear(self):
+        self._queue.clear()
+        self._changed()
+
+    def shuffle(self):
+        songs = list(self._queue)
+        random.shuffle(songs)
+        self._queue.rebuild(songs)
+        self._changed()
+
+    def remove(self, index: int):
+        del self._queue[index]
+        self._changed()
+
+    def remove_range(self, start: int, stop: int):
+        before = len(self._queue)
+        del self._queue[start:stop]
+        self._changed()
+        return before - len(self._queue)
+
+    def move(self, index: int, destination: int):
+        item = self._queue.pop(index)
+        self._queue.insert(destination, item)
+        self._changed()
+        return item
+
+    def remove_where(self, predicate):
+        before = len(self._queue)
+        self._queue.rebuild(item for item in self._queue if not predicate(item))
+        removed = before - len(self._queue)
+        if removed:
+            self._changed()
+        return removed
+
+    def dedupe(self, key):
+        seen = set()
+
+        def duplicate(item):
+            k = key(item)
+            if k in seen:
+                return True
+            seen.add(k)
+            return False
+
+        return self.remove_where(duplicate)
+
+
+class StateStore(SQLiteStore):
+    """Queues and player settings per guild in SQLite, so a restart doesn't lose them.
+
+    Writes are batched by the caller and go through a single writer thread;
+    reads only ever touch the one guild being restored.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS guilds (
+            guild_id INTEGER PRIMARY KEY,
+            loop INTEGER NOT NULL,
+            volume REAL NOT NULL,
+            eq TEXT,
+            resume_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS songs (
+            guild_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (guild_id, position)
+        );
+    '''
+
+    def __init__(self, path: str):
+        super().__init__(path, name='store')
+
+    async def load(self, guild_id: int, *, loop: asyncio.BaseEventLoop = None):
+        # Behind any save still in flight, so a guild reads back what was last written.
+        return await self.run(self._load, guild_id, loop=loop)
+
+    def _load(self, guild_id: int):
+        settings = self.writer.execute('SELECT loop, volume, eq, resume_at FROM guilds WHERE guild_id = ?',
+                                        (guild_id,)).fetchone()
+        if settings is None:
+            return None
+
+        songs = self.writer.execute('SELECT payload FROM songs WHERE guild_id = ? ORDER BY position', (guild_id,))
+        return settings, [json.loads(payload) for payload, in songs]
+
+    async def save(self, snapshots: list, positions: list, *, loop: asyncio.BaseEventLoop = None):
+        await self.run(self._save, snapshots, positions, loop=loop)
+
+    async def forget(self, guild_id: int, *, loop: asyncio.BaseEventLoop = None):
+        await self.run(self._forget, guild_id, loop=loop)
+
+    def _save(self, snapshots: list, positions: list):
+        now = time.time()
+        with self.writer as db:
+            for guild_id, settings, songs in snapshots:
+                db.execute('INSERT OR REPLACE INTO guilds VALUES (?, ?, ?, ?, ?, ?)', (guild_id, *settings, now))
+                db.execute('DELETE FROM songs WHERE guild_id = ?', (guild_id,))
+                db.executemany('INSERT INTO songs VALUES (?, ?, ?)',
+                               ((guild_id, i, json.dumps(song)) for i, song in enumerate(songs)))
+
+            db.executemany('UPDATE guilds SET resume_at = ?, updated_at = ? WHERE guild_id = ?',
+                           ((position, now, guild_id) for guild_id, position in positions))
+
+    def _forget(self, guild_id: int):
+        with self.writer as db:
+            db.execute('DELETE FROM guilds WHERE guild_id = ?', (guild_id,))
+            db.execute('DELETE FROM songs WHERE guild_id = ?', (guild_id,))
+
+
+class TimerWheel:
+    """Hashed timer wheel: O(1) to arm or move a timer, one task ticking for all of them.
+
+    Every key has at most one pending timer; arming it again moves it.
+    Deadlines are rounded up to the next tick.
+    """
+
+    def __init__(self, callback, *, tick: float = 1.0, slots: int = 512):
+        self.callback = callback
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._deadlines = {}
+        self._origin = time.monotonic()
+        self._cursor = 0
+        self._task = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _now(self):
+        return int((time.monotonic() - self._origin) / self.tick)
+
+    def schedule(self, key, delay: float, *, loop: asyncio.BaseEventLoop = None):
+        due = max(self._cursor, self._now() + math.ceil(delay / self.tick))
+        self._deadlines[key] = due
+        self._slots[due % len(self._slots)].add(key)
+
+        if self._task is None:
+            self._task = (loop or asyncio.get_event_loop()).create_task(self._run())
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    async def _run(self):
+        try:
+            while self._deadlines:
+                await asyncio.sleep(self.tick)
+
+                # Catch up on every tick we slept through if the loop lagged.
+                now = self._now()
+                while self._cursor <= now:
+                    slot = self._slots[self._cursor % len(self._slots)]
+                    for key in list(slot):
+                        due = self._deadlines.get(key)
+                        if due is None or due % len(self._slots) != self._cursor % len(self._slots):
+                            slot.discard(key)  # Cancelled, or moved to another slot.
+                        elif due <= self._cursor:
+                            slot.discard(key)
+                            del self._deadlines[key]
+                            self.callback(key)
+                    self._cursor += 1
+        finally:
+            self._task = None
+
+
+class Outbox:
+    __slots__ = ('channel', 'lines', 'enqueued', 'embed', 'reactions', 'now_playing', 'sent', 'reacted',
+                 'wakeup', 'task')
 
-    FFMPEG_OPTIONS = {
-        'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-        'options': '-vn',
-    }
+    def __init__(self, channel: discord.abc.Messageable):
+        self.channel = channel
+        self.lines = []
+        self.enqueued = []
+        self.embed = None
+        self.reactions = collections.deque(maxlen=MessageScheduler.MAX_REACTIONS)
+        self.now_playing = None
+        self.sent = collections.deque(maxlen=MessageScheduler.RATE)
+        self.reacted = 0.0
+        self.wakeup = asyncio.Event()
+        self.task = None
 
-    ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
-    ytdl.cache.remove()
-
-    def __init__(self, ctx: commands.Context, source: discord.FFmpegPCMAudio, *, data: dict, volume: float = 0.5):
-        super().__init__(source, volume)
-
-        self.requester = ctx.author
-        self.channel = ctx.channel
-        self.data = data
-
-        self.uploader = data.get('uploader')
-        self.uploader_url = data.get('uploader_url')
-        date = data.get('upload_date')
-        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4]
-        self.title = data.get('title')
-        self.thumbnail = data.get('thumbnail')
-        self.description = data.get('description')
-        self.duration = self.parse_duration(int(data.get('duration')))
-        self.tags = data.get('tags')
-        self.url = data.get('webpage_url')
-        self.views = data.get('view_count')
-        self.likes = data.get('like_count')
-        self.dislikes = data.get('dislike_count')
-        self.stream_url = data.get('url')
+    def __len__(self):
+        return bool(self.lines or self.enqueued) + (self.embed is not None) + len(self.reactions)
 
-    def __str__(self):
-        return '**{0.title}** by **{0.uploader}**'.format(self)
 
-    @classmethod
-    async def create_source(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):
-        loop = loop or asyncio.get_event_loop()
+class MessageScheduler:
+    """Bot chatter that doesn't answer a command, merged per channel and paced under Discord's rate limits.
 
-        partial = functools.partial(cls.ytdl.extract_info, search, download=False, process=False)
-        data = await loop.run_in_executor(None, partial)
+    Callers only queue things up, nothing here is ever awaited by a command or
+    the player. One worker per channel waits for a free slot in the channel's
+    bucket and then sends whatever piled up in the meantime as a single
+    message, so the busier a channel gets the more each message carries.
+    Now-playing embeds edit the previous one while it's still the newest
+    message in the channel; reactions are dropped, oldest first, if they back up.
+    """
 
-        if data is None:
-            raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+    # Discord allows 5 messages per 5 seconds per channel, and a reaction
+    # every quarter of a second.
+    RATE = 5
+    PER = 5.0
+    REACTION_INTERVAL = 0.25
+    MAX_REACTIONS = 5
 
-        if 'entries' not in data:
-            process_info = data
-        else:
-            process_info = None
-            for entry in data['entries']:
-                if entry:
-                    process_info = entry
-                    break
+    COALESCE_DELAY = float(os.environ.get('KRONOS_COALESCE_DELAY', 0.5))
+    IDLE_TIMEOUT = 60
 
-            if process_info is None:
-                raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+    def __init__(self, loop: asyncio.BaseEventLoop):
+        self.loop = loop
+        self._outboxes = {}
 
-        webpage_url = process_info['webpage_url']
-        partial = functools.partial(cls.ytdl.extract_info, webpage_url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+    def _outbox(self, channel: discord.abc.Messageable):
+        outbox = self._outboxes.get(channel.id)
+        if outbox is None:
+            outbox = self._outboxes[channel.id] = Outbox(channel)
 
-        if processed_info is None:
-            raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
+        if outbox.task is None:
+            outbox.task = self.loop.create_task(self._deliver(outbox))
 
-        if 'entries' not in processed_info:
-            info = processed_info
-        else:
-            info = None
-            while info is None:
-                try:
-                    info = processed_info['entries'].pop(0)
-                except IndexError:
-                    raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
+        outbox.wakeup.set()
+        return outbox
 
-        return cls(ctx, discord.FFmpegPCMAudio(info['url'], **cls.FFMPEG_OPTIONS), data=info)
+    def say(self, channel: discord.abc.Messageable, content: str):
+        self._outbox(channel).lines.append(content)
 
-    @staticmethod
-    def parse_duration(duration: int):
-        minutes, seconds = divmod(duration, 60)
-        hours, minutes = divmod(minutes, 60)
-        days, hours = divmod(hours, 24)
+    def enqueued(self, channel: discord.abc.Messageable, song: 'Song'):
+        self._outbox(channel).enqueued.append(str(song))
 
-        duration = []
-        if days > 0:
-            duration.append('{} days'.format(days))
-        if hours > 0:
-            duration.append('{} hours'.format(hours))
-        if minutes > 0:
-            duration.append('{} minutes'.format(minutes))
-        if seconds > 0:
-            duration.append('{} seconds'.format(seconds))
+    def now_playing(self, channel: discord.abc.Messageable, embed: discord.Embed):
+        # Only the latest embed matters if several songs went by meanwhile.
+        self._outbox(channel).embed = embed
 
-        return ', '.join(duration)
+    def react(self, message: discord.Message, emoji: str):
+        self._outbox(message.channel).reactions.append((message, emoji))
 
+    @property
+    def pending(self):
+        return sum(len(outbox) for outbox in self._outboxes.values())
 
-class Song:
-    __slots__ = ('source', 'requester')
+    def forget(self, guild_id: int):
+        """Lets go of a guild's outboxes and the now-playing messages they hold on to."""
 
-    def __init__(self, source: YTDLSource):
-        self.source = source
-        self.requester = source.requester
+        for outbox in list(self._outboxes.values()):
+            guild = getattr(outbox.channel, 'guild', None)
+            if guild is None or guild.id != guild_id:
+                continue
 
-    def create_embed(self):
-        embed = (discord.Embed(title='Now playing',
-                               description='```css\n{0.source.title}\n```'.format(self),
-                               color=discord.Color.blurple())
-                 .add_field(name='Duration', value=self.source.duration)
-                 .add_field(name='Requested by', value=self.requester.mention)
-                 .add_field(name='Uploader', value='[{0.source.uploader}]({0.source.uploader_url})'.format(self))
-                 .add_field(name='URL', value='[Click]({0.source.url})'.format(self))
-                 .set_thumbnail(url=self.source.thumbnail))
+            outbox.now_playing = None
+            if outbox.task is None:
+                # A running worker drops it itself once it's delivered the rest.
+                del self._outboxes[outbox.channel.id]
 
-        return embed
+    async def _deliver(self, outbox: Outbox):
+        try:
+            while True:
+                try:
+                    async with timeout(self.IDLE_TIMEOUT):
+                        await outbox.wakeup.wait()
+                except asyncio.TimeoutError:
+                    return
 
+                # Give a burst of commands a moment to land in the same message.
+                await asyncio.sleep(self.COALESCE_DELAY)
+                outbox.wakeup.clear()
 
-class SongQueue(asyncio.Queue):
-    def __getitem__(self, item):
-        if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
-        else:
-            return self._queue[item]
+                while len(outbox):
+                    try:
+                        await self._send_next(outbox)
+                    except discord.HTTPException:
+                        pass  # Missing permissions, deleted message, ...
+        finally:
+            outbox.task = None
+            if not len(outbox) and outbox.now_playing is None:
+                self._outboxes.pop(outbox.channel.id, None)
 
-    def __iter__(self):
-        return self._queue.__iter__()
+    async def _wait_for_slot(self, outbox: Outbox):
+        if len(outbox.sent) == self.RATE:
+            wait = outbox.sent[0] + self.PER - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        outbox.sent.append(time.monotonic())
 
-    def __len__(self):
-        return self.qsize()
+    async def _send_next(self, outbox: Outbox):
+        if outbox.lines or outbox.enqueued:
+            await self._wait_for_slot(outbox)
 
-    def clear(self):
-        self._queue.clear()
+            lines, outbox.lines = outbox.lines, []
+            enqueued, outbox.enqueued = outbox.enqueued, []
+            if len(enqueued) == 1:
+                lines.insert(0, 'Enqueued {}'.format(enqueued[0]))
+            elif enqueued:
+                shown = ', '.join(enqueued[:5])
+                more = ' and {} more'.format(len(enqueued) - 5) if len(enqueued) > 5 else ''
+                lines.insert(0, 'Enqueued **{}** tracks: {}{}'.format(len(enqueued), shown, more))
 
-    def shuffle(self):
-        random.shuffle(self._queue)
+            started = time.perf_counter()
+            await outbox.channel.send('\n'.join(lines)[:2000])
+            metrics.observe('kronos_stage_seconds', time.perf_counter() - started, stage='message_send')
 
-    def remove(self, index: int):
-        del self._queue[index]
+        elif outbox.embed is not None:
+            await self._wait_for_slot(outbox)
+
+            embed, outbox.embed = outbox.embed, None
+            message = outbox.now_playing
+
+            started = time.perf_counter()
+            if message is not None and getattr(outbox.channel, 'last_message_id', None) == message.id:
+                await message.edit(embed=embed)
+            else:
+                outbox.now_playing = await outbox.channel.send(embed=embed)
+            metrics.observe('kronos_stage_seconds', time.perf_counter() - started, stage='embed_send')
+
+        else:
+            wait = outbox.reacted + self.REACTION_INTERVAL - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            outbox.reacted = time.monotonic()
+
+            if outbox.reactions:
+                message, emoji = outbox.reactions.popleft()
+                await message.add_reaction(emoji)
 
 
 class VoiceState:
-    def __init__(self, bot: commands.Bot, ctx: commands.Context):
+    # How many queued songs get their stream URLs re-validated ahead of time,
+    # and how long before the end of a track the next one is spun up.
+    LOOKAHEAD = int(os.environ.get('KRONOS_LOOKAHEAD', 3))
+    PREWARM_SECONDS = float(os.environ.get('KRONOS_PREWARM_SECONDS', 5))
+
+    # At 1.0 the opus engine passes Opus packets through untouched.
+    DEFAULT_VOLUME = float(os.environ.get('KRONOS_DEFAULT_VOLUME', 0.5))
+
+    # A song whose FFmpeg the governor killed for stalling picks up where
+    # it stopped, with a fresh stream URL, this many times.
+    STALL_RESTARTS = int(os.environ.get('KRONOS_STALL_RESTARTS', 2))
+
+    IDLE = 'idle'
+    CONNECTED = 'connected'
+    PLAYING = 'playing'
+    SUSPENDED = 'suspended'
+
+    def __init__(self, bot: commands.Bot, ctx: commands.Context, messages: MessageScheduler):
         self.bot = bot
         self._ctx = ctx
+        self.messages = messages
+        self.guild_id = ctx.guild.id
 
         self.current = None
+        self._voice_ready = asyncio.Event()
         self.voice = None
         self.next = asyncio.Event()
-        self.songs = SongQueue()
+        self.songs = SongQueue(on_change=self.touch)
+        self.dirty = False
 
         self._loop = False
-        self._volume = 0.5
+        self._volume = self.DEFAULT_VOLUME
+        self._eq = None
         self.skip_votes = set()
 
-        self.audio_player = bot.loop.create_task(self.audio_player_task())
+        self.gaps = collections.deque(maxlen=100)
+        self._started_at = None
+        self._ended_at = None
+        self._prefetcher = None
+        self._warming = None
+        self._restarts = 0
+        self.loaders = set()
+        self.restoring = None
+        self.last_active = time.monotonic()
 
-    def __del__(self):
-        self.audio_player.cancel()
+        self.audio_player = bot.loop.create_task(self.audio_player_task())
 
     @property
     def loop(self):
@@ -204,6 +2986,20 @@ class VoiceState:
     @loop.setter
     def loop(self, value: bool):
         self._loop = value
+        self.touch()
+
+    @property
+    def voice(self):
+        return self._voice
+
+    @voice.setter
+    def voice(self, value: discord.VoiceClient):
+        self._voice = value
+
+        if value is None:
+            self._voice_ready.clear()
+        else:
+            self._voice_ready.set()
 
     @property
     def volume(self):
@@ -212,69 +3008,457 @@ class VoiceState:
     @volume.setter
     def volume(self, value: float):
         self._volume = value
+        self.touch()
+
+        if self.current is not None:
+            self.current.retune(value, self._eq, self.voice)
+
+    @property
+    def eq(self):
+        return self._eq
+
+    @eq.setter
+    def eq(self, value: str):
+        self._eq = value
+        self.touch()
+
+        if self.current is not None:
+            self.current.retune(self._volume, value, self.voice)
 
     @property
     def is_playing(self):
         return self.voice and self.current
 
+    def touch(self):
+        self.dirty = True
+        self.last_active = time.monotonic()
+
+    @property
+    def status(self):
+        """`playing`, `suspended` (paused, or has songs but no voice connection), `connected` or `idle`."""
+
+        if self.current is not None or len(self.songs):
+            if self.voice is not None and self.voice.is_playing():
+                return self.PLAYING
+            return self.SUSPENDED
+
+        return self.CONNECTED if self.voice is not None else self.IDLE
+
+    def resources(self):
+        sources = [song.source for song in (self.current, self._warming and self._warming[0]) if song and song.source]
+        tasks = [task for task in (self.audio_player, self._prefetcher, self._warming and self._warming[1])
+                 if task is not None and not task.done()]
+
+        return {
+            'status': self.status,
+            'idle_for': round(time.monotonic() - self.last_active, 1),
+            'queued': len(self.songs),
+            'sources': len(sources),
+            'ffmpeg': sum(1 for source in sources if ffmpeg_running(source)),
+            'tasks': len(tasks),
+            'voice': self.voice is not None,
+        }
+
+    def snapshot(self):
+        songs = [song.payload() for song in self.songs]
+
+        resume_at = 0
+        if self.current is not None:
+            # Still waiting for voice or warming up counts as playing: the
+            # song keeps its place and the position it is meant to start at.
+            songs.insert(0, self.current.payload())
+            source = self.current.source
+            resume_at = source.position if source is not None else self.current.start
+
+        return self.guild_id, (self._loop, self._volume, self._eq, resume_at), songs
+
+    def restore(self, saved: tuple):
+        (loop, volume, eq, resume_at), payloads = saved
+        self._loop = bool(loop)
+        self._volume = volume
+        self._eq = eq
+
+        songs = [Song.from_payload(payload, self._ctx) for payload in payloads]
+        if songs:
+            # Whatever was playing picks up where it left off.
+            songs[0].start = resume_at
+
+        self.songs.extend(songs)
+
+        self.dirty = False
+
+    @property
+    def gap_stats(self):
+        if not self.gaps:
+            return {'count': 0, 'last': None, 'average': None, 'max': None}
+
+        return {'count': len(self.gaps), 'last': self.gaps[-1],
+                'average': sum(self.gaps) / len(self.gaps), 'max': max(self.gaps)}
+
     async def audio_player_task(self):
+        restart = False
+        resume = False
         while True:
             self.next.clear()
 
-            if not self.loop:
-                # Try to get the next song within 3 minutes.
-                # If no song will be added to the queue in time,
-                # the player will disconnect due to performance
-                # reasons.
+            if restart:
+                self._restarts += 1
+            elif resume:
+                resume = False
+            elif not self.loop or self.current is None:
+                if len(self.songs) == 0:
+                    # Waiting on an empty queue isn't a gap between tracks.
+                    self._ended_at = None
+
+                # Waits as long as it takes; Music evicts guilds that stay
+                # idle for too long.
+                self.current = None
+                self.current = await self.songs.get()
+                self._restarts = 0
+
+            # A restored queue waits for the bot to be brought back to voice.
+            await self._voice_ready.wait()
+
+            if self._prefetcher is not None:
+                self._prefetcher.cancel()
+                self._prefetcher = None
+
+            if self._warming is not None:
+                song, task = self._warming
+                self._warming = None
+                if song is self.current:
+                    await asyncio.wait({task})
+                else:
+                    # Skipped, removed or moved since: don't leave its FFmpeg running.
+                    task.cancel()
+                    await asyncio.wait({task})
+                    song.release()
+
+            try:
+                started = time.perf_counter()
+                while True:
+                    try:
+                        await self.current.warm(volume=self._volume, eq=self._eq, loop=self.bot.loop)
+                        break
+                    except FFmpegBusy:
+                        # Every FFmpeg slot is taken: the song isn't at fault,
+                        # keep it and wait for the next free slot.
+                        pass
+                metrics.observe('kronos_stage_seconds', time.perf_counter() - started, stage='warm')
+
+                started = time.perf_counter()
+                self.current.source.clock.started = started
                 try:
-                    async with timeout(180):  # 3 minutes
-                        self.current = await self.songs.get()
-                except asyncio.TimeoutError:
-                    self.bot.loop.create_task(self.stop())
-                    return
+                    self.voice.play(self.current.source, after=self.play_next_song)
+                except discord.ClientException:
+                    if self.voice.is_connected():
+                        raise
+
+                    # Not this song's fault: hold the queue until voice is back.
+                    await self.suspend()
+                    resume = True
+                    continue
+                metrics.observe('kronos_stage_seconds', time.perf_counter() - started, stage='voice_play')
+            except YTDLError as e:
+                self.messages.say(self.current.channel, 'Skipping **{}**: {}'.format(self.current.title, str(e)))
+                self.current = None
+                continue
+            except (discord.ClientException, OSError) as e:
+                # FFmpeg couldn't be started (missing, out of processes, ...):
+                # the player has to survive it and go on with the queue.
+                self.messages.say(self.current.channel, 'Couldn\'t play **{}**: {}'.format(self.current.title, str(e)))
+                self.current.release()
+                self.current = None
+                continue
 
-            self.current.source.volume = self._volume
-            self.voice.play(self.current.source, after=self.play_next_song)
-            await self.current.source.channel.send(embed=self.current.create_embed())
+            metrics.inc('kronos_songs_played_total')
+            self.touch()
+            self._started_at = time.monotonic()
+            if self._ended_at is not None:
+                self.gaps.append(self._started_at - self._ended_at)
+
+            self._prefetcher = self.bot.loop.create_task(self.prefetch_task(self.current))
+            YTDLSource.loudness.schedule(self.current, loop=self.bot.loop)
+            YTDLSource.cache.schedule(self.current, loop=self.bot.loop)
+            YTDLSource.history.played(self.current.track)
+            self.messages.now_playing(self.current.channel, self.current.create_embed())
 
             await self.next.wait()
 
+            source = self.current.source
+            restart = (getattr(source, 'stalled', False) and self._restarts < self.STALL_RESTARTS
+                       and source.position < self.current.length - self.PREWARM_SECONDS)
+            if restart:
+                # Most likely an expired or dead stream URL: get a new one.
+                self.current.start = source.position
+                self.current.expires_at = 0
+                YTDLSource.info_cache.discard(self.current.track.id)
+                YTDLSource.governor.restarts += 1
+                metrics.inc('kronos_ffmpeg_restarts_total')
+
+            # The FFmpeg process is spent; a looped song gets a fresh one.
+            self.current.release()
+            self.touch()
+
+    async def prefetch_task(self, song: Song):
+        # Look-ahead: make sure the next few songs have fresh stream URLs in
+        # the caches well before they come up.
+        for upcoming in self.songs[:self.LOOKAHEAD]:
+            try:
+                await upcoming.prefetch(loop=self.bot.loop)
+            except YTDLError:
+                pass  # Reported by the player once the song comes up.
+
+        # Pre-warm: spawn FFmpeg for the immediate next song a few seconds
+        # before the current one ends so the switch is close to gapless.
+        remaining = song.length - (time.monotonic() - self._started_at) - self.PREWARM_SECONDS
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+
+        if self.loop or len(self.songs) == 0:
+            # A looping song is played again, the queue doesn't move.
+            return
+
+        upcoming = self.songs[0]
+        task = self.bot.loop.create_task(upcoming.warm(volume=self._volume, eq=self._eq, loop=self.bot.loop))
+        self._warming = (upcoming, task)
+
+        try:
+            await asyncio.shield(task)
+        except YTDLError:
+            pass
+
     def play_next_song(self, error=None):
-        if error:
-            raise VoiceError(str(error))
+        # Called from discord.py's audio thread, hand it over to the loop.
+        self._ended_at = time.monotonic()
+        self.bot.loop.call_soon_threadsafe(self._song_finished, time.perf_counter(), error)
 
+    def _song_finished(self, called_at: float, error=None):
+        metrics.observe('kronos_stage_seconds', time.perf_counter() - called_at, stage='after_callback')
+
+        # Always move on: an error raised first would leave the player
+        # waiting on `next` forever.
         self.next.set()
 
+        if error:
+            raise VoiceError(str(error))
+
     def skip(self):
         self.skip_votes.clear()
 
         if self.is_playing:
             self.voice.stop()
 
-    async def stop(self):
-        self.songs.clear()
+    async def suspend(self):
+        """Drops a voice connection that went away, keeping the current song and its position."""
+
+        if self.current.source is not None:
+            self.current.start = self.current.source.position
+            self.current.release()
+
+        voice, self.voice = self.voice, None
+        try:
+            # Lets go of the stale client so join can connect again.
+            await voice.disconnect(force=True)
+        except (discord.ClientException, OSError):
+            pass
+
+        self.messages.say(self.current.channel, 'Lost the voice connection, **{}** picks up where it left off once '
+                                                'I\'m brought back with `kronos.join`.'.format(self.current.title))
+
+    async def close(self):
+        """Tears down the player task, FFmpeg processes and the voice connection.
+
+        The queue itself is left alone so it can still be saved.
+        """
+
+        tasks = [task for task in (self.audio_player, self._prefetcher, self._warming and self._warming[1]) if task]
+        tasks += self.loaders
+        for task in tasks:
+            task.cancel()
+        self._prefetcher = None
+        self._warming = None
 
         if self.voice:
             await self.voice.disconnect()
             self.voice = None
 
+        if self.current is not None:
+            self.current.release()
+        for song in self.songs:
+            song.release()
+
+        YTDLSource.pool.cancel(self.guild_id)
+        await asyncio.wait(tasks)
+
 
 class Music(commands.Cog):
+    PERSIST_INTERVAL = float(os.environ.get('KRONOS_PERSIST_INTERVAL', 2))
+
+    # How long a guild may sit without anything to play (or paused / waiting
+    # for voice with songs queued) before its player is torn down. Suspended
+    # queues are saved first and come back on the next command.
+    IDLE_TIMEOUT = float(os.environ.get('KRONOS_IDLE_TIMEOUT', 180))
+    SUSPEND_TIMEOUT = float(os.environ.get('KRONOS_SUSPEND_TIMEOUT', 30 * 60))
+
+    SEARCH_RESULTS = int(os.environ.get('KRONOS_SEARCH_RESULTS', 5))
+    SEARCH_TIMEOUT = float(os.environ.get('KRONOS_SEARCH_TIMEOUT', 30))
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.voice_states = {}
 
-    def get_voice_state(self, ctx: commands.Context):
+        self.store = StateStore(os.environ.get('KRONOS_STATE_DB', 'kronos_state.db'))
+        self.persister = None
+        self.messages = MessageScheduler(bot.loop)
+        self.lifecycle = TimerWheel(self.check_idle)
+
+        metrics.gauge('kronos_queue_depth',
+                      lambda: [({'guild': guild_id}, len(state.songs)) for guild_id, state in self.voice_states.items()])
+        metrics.gauge('kronos_outbox_pending', lambda: [({}, self.messages.pending)])
+        metrics.gauge('kronos_voice_states', lambda: [({'state': status}, count) for status, count in
+                                                      collections.Counter(state.status for state in
+                                                                          self.voice_states.values()).items()])
+        metrics.gauge('kronos_playing', lambda: [({}, sum(1 for state in self.voice_states.values() if state.is_playing))])
+        metrics.gauge('kronos_extractor', lambda: [({'stat': stat}, value)
+                                                   for stat, value in YTDLSource.pool.stats().items()])
+        metrics.gauge('kronos_extractor_saturated', lambda: [({}, int(YTDLSource.pool.saturated))])
+        metrics.gauge('kronos_shared_streams', lambda: [({'stat': stat}, value)
+                                                        for stat, value in YTDLSource.hub.stats().items()])
+        metrics.gauge('kronos_audio_cache', lambda: [({'stat': stat}, value)
+                                                     for stat, value in YTDLSource.cache.stats().items()])
+        metrics.gauge('kronos_cache', lambda: [({'cache': name, 'stat': stat}, value)
+                                               for name, cache in (('search', YTDLSource.search_cache),
+                                                                   ('info', YTDLSource.info_cache))
+                                               for stat, value in cache.stats().items()])
+        metrics.gauge('kronos_loop_lag_last_seconds', lambda: [({}, metrics.loop_lag)])
+        metrics.gauge('kronos_ffmpeg', lambda: [({'stat': stat}, value)
+                                                for stat, value in YTDLSource.governor.stats().items()])
+        metrics.gauge('kronos_http', lambda: [({'stat': stat}, value)
+                                              for stat, value in YTDLSource.http.stats().items()])
+        metrics.gauge('kronos_ffmpeg_cpu_seconds', lambda: [({}, round(YTDLSource.governor.cpu_seconds, 3))])
+
+    async def get_voice_state(self, ctx: commands.Context):
         state = self.voice_states.get(ctx.guild.id)
         if not state:
-            state = VoiceState(self.bot, ctx)
+            if self.persister is None:
+                self.persister = self.bot.loop.create_task(self.persist_task())
+
+            state = VoiceState(self.bot, ctx, self.messages)
             self.voice_states[ctx.guild.id] = state
+            self.lifecycle.schedule(ctx.guild.id, self.IDLE_TIMEOUT, loop=self.bot.loop)
+
+            # Guilds are only brought back from the store once they're used
+            # again, so startup cost doesn't depend on how many are saved.
+            state.restoring = self.bot.loop.create_task(self.store.load(ctx.guild.id, loop=self.bot.loop))
+
+        restoring = state.restoring
+        if restoring is not None:
+            # Commands arriving meanwhile wait too, so nothing is queued ahead of the saved songs.
+            try:
+                saved = await asyncio.shield(restoring)
+            except Exception:
+                if state.restoring is restoring:
+                    state.restoring = None  # Go on without the saved queue.
+                raise
+
+            if state.restoring is restoring:
+                state.restoring = None
+                if saved is not None:
+                    state.restore(saved)
 
         return state
 
-    def cog_unload(self):
+    def check_idle(self, guild_id: int):
+        state = self.voice_states.get(guild_id)
+        if state is None:
+            return
+
+        status = state.status
+        if status == VoiceState.PLAYING:
+            return self.lifecycle.schedule(guild_id, self.IDLE_TIMEOUT, loop=self.bot.loop)
+
+        limit = self.SUSPEND_TIMEOUT if status == VoiceState.SUSPENDED else self.IDLE_TIMEOUT
+        remaining = state.last_active + limit - time.monotonic()
+        if remaining > 0:
+            self.lifecycle.schedule(guild_id, remaining, loop=self.bot.loop)
+        else:
+            self.bot.loop.create_task(self.evict(guild_id))
+
+    async def evict(self, guild_id: int, *, forget: bool = False):
+        """Removes a guild's player for good, saving its queue unless told to forget it."""
+
+        state = self.voice_states.pop(guild_id, None)
+        self.lifecycle.cancel(guild_id)
+        self.messages.forget(guild_id)
+        if state is None:
+            return
+
+        if forget:
+            await state.close()
+            await self.store.forget(guild_id, loop=self.bot.loop)
+        else:
+            # Snapshot first, closing releases the current song's position.
+            snapshot = state.snapshot()
+            await state.close()
+            await self.store.save([snapshot], [], loop=self.bot.loop)
+
+    async def persist_task(self):
+        while True:
+            await asyncio.sleep(self.PERSIST_INTERVAL)
+            try:
+                await self.persist()
+            except Exception as e:
+                # A locked or full database: keep the persister, try again next round.
+                print('Saving queues failed: {!r}'.format(e), file=sys.stderr)
+
+    async def persist(self):
+        saved = []
+        snapshots = []
+        positions = []
+        for state in list(self.voice_states.values()):
+            if state.dirty:
+                # Cleared up front so changes made while saving count for the next round.
+                state.dirty = False
+                saved.append(state)
+                snapshots.append(state.snapshot())
+            elif state.current is not None and state.current.source is not None:
+                positions.append((state.guild_id, state.current.source.position))
+
+        if snapshots or positions:
+            try:
+                await self.store.save(snapshots, positions, loop=self.bot.loop)
+            except BaseException:
+                for state in saved:
+                    state.dirty = True
+                raise
+
+    async def drain(self):
+        # Used when the launcher moves our shards to another worker: the
+        # queues are saved but left intact so the new owner can pick them up.
+        if self.persister is not None:
+            self.persister.cancel()
+            self.persister = None
+
         for state in self.voice_states.values():
-            self.bot.loop.create_task(state.stop())
+            state.audio_player.cancel()
+
+        await self.persist()
+
+        for guild_id in list(self.voice_states):
+            state = self.voice_states.pop(guild_id)
+            self.lifecycle.cancel(guild_id)
+            await state.close()
+
+    def cog_unload(self):
+        if self.persister is not None:
+            self.persister.cancel()
+            self.persister = None
+
+        for guild_id in list(self.voice_states):
+            self.bot.loop.create_task(self.evict(guild_id))
+
+        YTDLSource.pool.shutdown()
 
     def cog_check(self, ctx: commands.Context):
         if not ctx.guild:
@@ -283,7 +3467,8 @@ class Music(commands.Cog):
         return True
 
     async def cog_before_invoke(self, ctx: commands.Context):
-        ctx.voice_state = self.get_voice_state(ctx)
+        ctx.voice_state = await self.get_voice_state(ctx)
+        ctx.voice_state.last_active = time.monotonic()
 
     async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
         await ctx.send('An error occurred: {}'.format(str(error)))
@@ -324,8 +3509,7 @@ class Music(commands.Cog):
         if not ctx.voice_state.voice:
             return await ctx.send('Not connected to any voice channel.')
 
-        await ctx.voice_state.stop()
-        del self.voice_states[ctx.guild.id]
+        await self.evict(ctx.guild.id, forget=True)
 
     @commands.command(name='volume')
     async def _volume(self, ctx: commands.Context, *, volume: int):
@@ -340,12 +3524,102 @@ class Music(commands.Cog):
         ctx.voice_state.volume = volume / 100
         await ctx.send('Volume of the player set to {}%'.format(volume))
 
+    @commands.command(name='eq', aliases=['equalizer'])
+    async def _eq(self, ctx: commands.Context, *, preset: str = None):
+        """Sets the equalizer preset of the player.
+        Invoke without a preset to list them, use `off` to turn the equalizer off.
+        """
+
+        presets = ', '.join('`{}`'.format(name) for name in Equalizer.PRESETS)
+
+        if preset is None:
+            return await ctx.send('Equalizer is **{}**. Available presets: {}'.format(ctx.voice_state.eq or 'off', presets))
+
+        if numpy is None:
+            return await ctx.send('The equalizer isn\'t available on this bot.')
+
+        preset = preset.lower()
+        if preset in ('off', 'flat'):
+            ctx.voice_state.eq = None
+        elif preset in Equalizer.PRESETS:
+            ctx.voice_state.eq = preset
+        else:
+            return await ctx.send('Unknown preset. Available presets: {}'.format(presets))
+
+        self.messages.react(ctx.message, '✅')
+
     @commands.command(name='now', aliases=['current', 'playing'])
     async def _now(self, ctx: commands.Context):
         """Displays the currently playing song."""
 
         await ctx.send(embed=ctx.voice_state.current.create_embed())
 
+    @commands.command(name='stats')
+    async def _stats(self, ctx: commands.Context):
+        """Shows where the bot is spending its time."""
+
+        def ms(value):
+            if value is None:
+                return '-'
+            if value == math.inf:
+                return '>30s'
+            return '{:.0f}ms'.format(value * 1000)
+
+        lag = metrics.histogram('kronos_loop_lag_seconds')
+        lines = ['Event loop lag: {} now, p99 <= {}'.format(ms(metrics.loop_lag), ms(lag.quantile(0.99))), '',
+                 '{:<15}{:>8}{:>8}{:>8}'.format('stage', 'p50', 'p95', 'count')]
+
+        for stage in ('search', 'process', 'warm', 'ffmpeg_spawn', 'voice_play', 'first_packet',
+                      'embed_send', 'message_send', 'after_callback'):
+            histogram = metrics.histogram('kronos_stage_seconds', stage=stage)
+            lines.append('{:<15}{:>8}{:>8}{:>8}'.format(stage, ms(histogram.quantile(0.5)),
+                                                         ms(histogram.quantile(0.95)), histogram.count))
+
+        jitter = metrics.histogram('kronos_frame_jitter_seconds', Metrics.JITTER_BUCKETS)
+        pool = YTDLSource.pool.stats()
+        gaps = ctx.voice_state.gap_stats
+
+        lines += ['',
+                  'Frame jitter: p50 <= {}, p99 <= {}'.format(ms(jitter.quantile(0.5)), ms(jitter.quantile(0.99))),
+                  'Extractors: {running}/{workers} busy, {pending} waiting{saturated}'.format(
+                      saturated=' (saturated)' if YTDLSource.pool.saturated else '', **pool),
+                  'History: {tracks} tracks, {hits} searches answered locally, {misses} not'.format(
+                      **YTDLSource.history.stats()),
+                  'HTTP: {requests} requests over {connections} connections, {reused} reused, {idle} idle'.format(
+                      **YTDLSource.http.stats()),
+                  'FFmpeg: {running}/{limit} running ({background} background, {waiting} waiting), {cpu} CPU, '
+                  '{stalled} stalled, {restarts} restarted'.format(
+                      cpu='-' if YTDLSource.governor.cpu is None else '{:.0%}'.format(YTDLSource.governor.cpu),
+                      **YTDLSource.governor.stats()),
+                  'Queue here: {}, playing in {} of {} guilds'.format(
+                      len(ctx.voice_state.songs), sum(1 for state in self.voice_states.values() if state.is_playing),
+                      len(self.voice_states)),
+                  'Gaps here: {} average, {} max'.format(ms(gaps['average']), ms(gaps['max'])),
+                  'Startup: {}'.format(startup.report())]
+
+        await ctx.send('```\n{}\n```'.format('\n'.join(lines)))
+
+    @commands.command(name='resources')
+    async def _resources(self, ctx: commands.Context):
+        """Shows what the player holds on to in this guild and across the bot."""
+
+        here = ctx.voice_state.resources()
+        totals = collections.Counter()
+        statuses = collections.Counter()
+        for state in self.voice_states.values():
+            resources = state.resources()
+            statuses[resources['status']] += 1
+            totals.update({key: resources[key] for key in ('queued', 'sources', 'ffmpeg', 'tasks', 'voice')})
+
+        lines = ['This guild: {status}, idle for {idle_for}s, {queued} queued, {sources} sources '
+                 '({ffmpeg} FFmpeg), {tasks} tasks, voice {voice}'.format(**here),
+                 'All guilds: {}'.format(', '.join('{} {}'.format(count, status) for status, count in statuses.items())),
+                 '  {queued} queued, {sources} sources ({ffmpeg} FFmpeg), {tasks} tasks, {voice} voice connections'
+                 .format(**totals),
+                 '  {} idle timers armed'.format(len(self.lifecycle))]
+
+        await ctx.send('```\n{}\n```'.format('\n'.join(lines)))
+
     @commands.command(name='pause')
     @commands.has_permissions(manage_guild=True)
     async def _pause(self, ctx: commands.Context):
@@ -353,7 +3627,7 @@ class Music(commands.Cog):
 
         if not ctx.voice_state.is_playing and ctx.voice_state.voice.is_playing():
             ctx.voice_state.voice.pause()
-            await ctx.message.add_reaction('⏯')
+            self.messages.react(ctx.message, '⏯')
 
     @commands.command(name='resume')
     @commands.has_permissions(manage_guild=True)
@@ -362,7 +3636,7 @@ class Music(commands.Cog):
 
         if not ctx.voice_state.is_playing and ctx.voice_state.voice.is_paused():
             ctx.voice_state.voice.resume()
-            await ctx.message.add_reaction('⏯')
+            self.messages.react(ctx.message, '⏯')
 
     @commands.command(name='stop')
     @commands.has_permissions(manage_guild=True)
@@ -370,10 +3644,13 @@ class Music(commands.Cog):
         """Stops playing song and clears the queue."""
 
         ctx.voice_state.songs.clear()
+        # Playlists still loading would fill the queue right back up.
+        for loader in ctx.voice_state.loaders:
+            loader.cancel()
 
         if not ctx.voice_state.is_playing:
             ctx.voice_state.voice.stop()
-            await ctx.message.add_reaction('⏹')
+            self.messages.react(ctx.message, '⏹')
 
     @commands.command(name='skip')
     async def _skip(self, ctx: commands.Context):
@@ -386,7 +3663,7 @@ class Music(commands.Cog):
 
         voter = ctx.message.author
         if voter == ctx.voice_state.current.requester:
-            await ctx.message.add_reaction('⏭')
+            self.messages.react(ctx.message, '⏭')
             ctx.voice_state.skip()
 
         elif voter.id not in ctx.voice_state.skip_votes:
@@ -394,7 +3671,7 @@ class Music(commands.Cog):
             total_votes = len(ctx.voice_state.skip_votes)
 
             if total_votes >= 3:
-                await ctx.message.add_reaction('⏭')
+                self.messages.react(ctx.message, '⏭')
                 ctx.voice_state.skip()
             else:
                 await ctx.send('Skip vote added, currently at **{}/3**'.format(total_votes))
@@ -417,9 +3694,8 @@ class Music(commands.Cog):
         start = (page - 1) * items_per_page
         end = start + items_per_page
 
-        queue = ''
-        for i, song in enumerate(ctx.voice_state.songs[start:end], start=start):
-            queue += '`{0}.` [**{1.source.title}**]({1.source.url})\n'.format(i + 1, song)
+        queue = ''.join('`{0}.` [**{1.title}**]({1.url})\n'.format(i + 1, song)
+                        for i, song in enumerate(ctx.voice_state.songs[start:end], start=start))
 
         embed = (discord.Embed(description='**{} tracks:**\n\n{}'.format(len(ctx.voice_state.songs), queue))
                  .set_footer(text='Viewing page {}/{}'.format(page, pages)))
@@ -433,7 +3709,7 @@ class Music(commands.Cog):
             return await ctx.send('Empty queue.')
 
         ctx.voice_state.songs.shuffle()
-        await ctx.message.add_reaction('✅')
+        self.messages.react(ctx.message, '✅')
 
     @commands.command(name='remove')
     async def _remove(self, ctx: commands.Context, index: int):
@@ -443,7 +3719,41 @@ class Music(commands.Cog):
             return await ctx.send('Empty queue.')
 
         ctx.voice_state.songs.remove(index - 1)
-        await ctx.message.add_reaction('✅')
+        self.messages.react(ctx.message, '✅')
+
+    @commands.command(name='move')
+    async def _move(self, ctx: commands.Context, index: int, destination: int):
+        """Moves a song in the queue to another position."""
+
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.send('Empty queue.')
+
+        song = ctx.voice_state.songs.move(index - 1, destination - 1)
+        await ctx.send('Moved {} to position **{}**'.format(str(song), min(destination, len(ctx.voice_state.songs))))
+
+    @commands.command(name='removerange')
+    async def _removerange(self, ctx: commands.Context, start: int, end: int):
+        """Removes every song from one position of the queue to another, both included."""
+
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.send('Empty queue.')
+
+        removed = ctx.voice_state.songs.remove_range(start - 1, end)
+        await ctx.send('Removed **{}** tracks.'.format(removed))
+
+    @commands.command(name='dedupe')
+    async def _dedupe(self, ctx: commands.Context):
+        """Removes songs that are already further up in the queue."""
+
+        removed = ctx.voice_state.songs.dedupe(lambda song: song.url)
+        await ctx.send('Removed **{}** duplicate tracks.'.format(removed))
+
+    @commands.command(name='removeuser')
+    async def _removeuser(self, ctx: commands.Context, *, member: discord.Member):
+        """Removes every song a member has queued."""
+
+        removed = ctx.voice_state.songs.remove_where(lambda song: song.requester.id == member.id)
+        await ctx.send('Removed **{}** tracks queued by {}.'.format(removed, member.mention))
 
     @commands.command(name='loop')
     async def _loop(self, ctx: commands.Context):
@@ -456,33 +3766,126 @@ class Music(commands.Cog):
 
         # Inverse boolean value to loop and unloop.
         ctx.voice_state.loop = not ctx.voice_state.loop
-        await ctx.message.add_reaction('✅')
+        self.messages.react(ctx.message, '✅')
 
     @commands.command(name='play')
     async def _play(self, ctx: commands.Context, *, search: str):
         """Plays a song.
         If there are songs in the queue, this will be queued until the
         other songs finished playing.
-        This command automatically searches from various sites if no URL is provided.
-        A list of these sites can be found here: https://rg3.github.io/youtube-dl/supportedsites.html
+        This command searches YouTube if no URL is provided; only YouTube
+        links (videos and playlists) can be played.
+        YouTube playlist links enqueue every track of the playlist.
         """
 
         if not ctx.voice_state.voice:
             await ctx.invoke(self._join)
 
+        playlist_url = YTDLSource.playlist_url(search)
+        if playlist_url:
+            return await self._play_playlist(ctx, playlist_url)
+
         async with ctx.typing():
             try:
-                source = await YTDLSource.create_source(ctx, search, loop=self.bot.loop)
+                song = await Song.create(ctx, search, loop=self.bot.loop)
             except YTDLError as e:
                 await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
             else:
-                song = Song(source)
-
                 await ctx.voice_state.songs.put(song)
-                await ctx.send('Enqueued {}'.format(str(source)))
+                self.messages.enqueued(ctx.channel, song)
+
+    @commands.command(name='search')
+    async def _search(self, ctx: commands.Context, *, search: str):
+        """Lists tracks matching a search to pick from.
+        Tracks played on the bot before are listed first (marked with a star),
+        then results from YouTube. Reply with a number to play that track,
+        anything else cancels.
+        """
+
+        async with ctx.typing():
+            try:
+                local, remote = await YTDLSource.candidates(search, limit=self.SEARCH_RESULTS,
+                                                            key=ctx.guild.id, loop=self.bot.loop)
+            except YTDLError as e:
+                return await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
+
+        tracks = local + remote
+        if not tracks:
+            return await ctx.send('Couldn\'t find anything that matches `{}`'.format(search))
+
+        results = ''.join('`{0}.` {1}[**{2.title}**]({2.url}) by {3} ({4}:{5:02d})\n'.format(
+                          i + 1, '⭐ ' if i < len(local) else '', track, track.uploader or 'unknown',
+                          *divmod(track.length, 60))
+                          for i, track in enumerate(tracks))
+
+        embed = (discord.Embed(description='**Results for {}:**\n\n{}'.format(search, results))
+                 .set_footer(text='Reply with a number within {:.0f} seconds'.format(self.SEARCH_TIMEOUT)))
+        await ctx.send(embed=embed)
+
+        def check(message: discord.Message):
+            return message.author == ctx.author and message.channel == ctx.channel
+
+        try:
+            reply = await self.bot.wait_for('message', check=check, timeout=self.SEARCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            return
+
+        picked = reply.content.strip()
+        if not picked.isdigit() or not 1 <= int(picked) <= len(tracks):
+            return
+
+        if not ctx.voice_state.voice:
+            await ctx.invoke(self._join)
+
+        async with ctx.typing():
+            try:
+                # The pick is known by id: one extractor call, and the search
+                # resolves straight to it from now on.
+                track, stream = await YTDLSource.resolve_track(tracks[int(picked) - 1], search,
+                                                               key=ctx.guild.id, loop=self.bot.loop)
+            except YTDLError as e:
+                return await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
+
+        song = Song(ctx.author, ctx.channel, track, stream)
+        await ctx.voice_state.songs.put(song)
+        self.messages.enqueued(ctx.channel, song)
+
+    async def _play_playlist(self, ctx: commands.Context, playlist_url: str):
+        page = min(YTDLSource.PLAYLIST_PAGE, YTDLSource.PLAYLIST_LIMIT)
+        async with ctx.typing():
+            try:
+                title, entries = await YTDLSource.create_playlist(ctx, playlist_url, limit=page, loop=self.bot.loop)
+            except YTDLError as e:
+                return await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
+
+        ctx.voice_state.songs.extend(Song(ctx.author, ctx.channel, Track.placeholder(url, song_title))
+                                     for url, song_title in entries)
+
+        title = title or playlist_url
+        if len(entries) < page or page == YTDLSource.PLAYLIST_LIMIT:
+            self.messages.say(ctx.channel, 'Enqueued **{}** tracks from **{}**'.format(len(entries), title))
+            return
+
+        self.messages.say(ctx.channel, 'Enqueued **{}** tracks from **{}**, loading the rest...'.format(len(entries),
+                                                                                                      title))
+        loader = self.bot.loop.create_task(self._load_playlist(ctx, playlist_url, title, page))
+        ctx.voice_state.loaders.add(loader)
+        loader.add_done_callback(ctx.voice_state.loaders.discard)
+
+    async def _load_playlist(self, ctx: commands.Context, playlist_url: str, title: str, start: int):
+        try:
+            _, entries = await YTDLSource.create_playlist(ctx, playlist_url, start=start, loop=self.bot.loop)
+        except YTDLError as e:
+            return self.messages.say(ctx.channel, 'Couldn\'t load the rest of **{}**: {}'.format(title, str(e)))
+
+        if entries:
+            ctx.voice_state.songs.extend(Song(ctx.author, ctx.channel, Track.placeholder(url, song_title))
+                                         for url, song_title in entries)
+            self.messages.say(ctx.channel, 'Enqueued **{}** more tracks from **{}**'.format(len(entries), title))
 
     @_join.before_invoke
     @_play.before_invoke
+    @_search.before_invoke
     async def ensure_voice_state(self, ctx: commands.Context):
         if not ctx.author.voice or not ctx.author.voice.channel:
             raise commands.CommandError('You are not connected to any voice channel.')
@@ -492,15 +3895,138 @@ class Music(commands.Cog):
                 raise commands.CommandError('Bot is already in a voice channel.')
 
 
-bot = commands.Bot('kronos.', description='Yet another music bot.')
+class ShardLink:
+    """Worker side of the launcher's IPC channel (see kronos_launcher.py)."""
+
+    INTERVAL = float(os.environ.get('KRONOS_HEARTBEAT_INTERVAL', 5))
+
+    def __init__(self, bot: commands.Bot, address: str, authkey: bytes, worker: int):
+        host, _, port = address.rpartition(':')
+        self.bot = bot
+        self.address = (host, int(port))
+        self.authkey = authkey
+        self.worker = worker
+        self.conn = None
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        loop = self.bot.loop
+        self.conn = await loop.run_in_executor(
+            None, functools.partial(multiprocessing.connection.Client, self.address, authkey=self.authkey))
+        self.conn.send({'worker': self.worker})
+        threading.Thread(target=self.listen, name='kronos-shard-link', daemon=True).start()
+
+        while True:
+            await loop.run_in_executor(None, self.conn.send, self.stats())
+            await asyncio.sleep(self.INTERVAL)
+
+    def listen(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                # The launcher went away; don't keep its shards orphaned.
+                message = {'command': 'drain'}
+
+            if message.get('command') == 'drain':
+                asyncio.run_coroutine_threadsafe(self.drain(), self.bot.loop)
+                return
+
+    async def drain(self):
+        music = self.bot.get_cog('Music')
+        if music is not None:
+            await music.drain()
+
+        await self.bot.close()
+
+    def stats(self):
+        music = self.bot.get_cog('Music')
+        states = music.voice_states.values() if music is not None else ()
+
+        return {
+            'worker': self.worker,
+            'pid': os.getpid(),
+            'shards': list(getattr(self.bot, 'shard_ids', None) or ()),
+            'ready': self.bot.is_ready(),
+            'guilds': len(self.bot.guilds),
+            'voice_states': len(states),
+            'states': dict(collections.Counter(state.status for state in states)),
+            'playing': sum(1 for state in states if state.is_playing),
+            'latency': self.bot.latency,
+            'loop_lag': metrics.loop_lag,
+            'extractor': YTDLSource.pool.stats(),
+            'per_shard': self.shard_stats(states),
+        }
+
+    def shard_stats(self, states):
+        """Gateway latency, guilds and voice states of each shard this worker runs."""
+
+        # Only AutoShardedBot has per-shard latencies; a plain Bot is shard 0.
+        latencies = getattr(self.bot, 'latencies', None) or [(0, self.bot.latency)]
+        shards = collections.defaultdict(lambda: {'latency': None, 'guilds': 0, 'voice_states': 0, 'playing': 0})
+        for shard_id, latency in latencies:
+            shards[shard_id]['latency'] = latency
+
+        for guild in self.bot.guilds:
+            shards[guild.shard_id]['guilds'] += 1
+
+        for state in states:
+            guild = self.bot.get_guild(state.guild_id)
+            if guild is not None:
+                shards[guild.shard_id]['voice_states'] += 1
+                shards[guild.shard_id]['playing'] += bool(state.is_playing)
+
+        return dict(shards)
+
+
+SHARD_COUNT = os.environ.get('KRONOS_SHARD_COUNT')
+SHARD_IDS = os.environ.get('KRONOS_SHARD_IDS')
+
+if SHARD_COUNT:
+    # Started by kronos_launcher.py: only connect the shards this worker owns.
+    bot = commands.AutoShardedBot('kronos.', description='Yet another music bot.',
+                                  shard_count=int(SHARD_COUNT),
+                                  shard_ids=[int(i) for i in SHARD_IDS.split(',')] if SHARD_IDS else None)
+else:
+    bot = commands.Bot('kronos.', description='Yet another music bot.')
 bot.add_cog(Music(bot))
 
+if os.environ.get('KRONOS_COORDINATOR'):
+    bot.shard_link = ShardLink(bot, os.environ['KRONOS_COORDINATOR'],
+                               bytes.fromhex(os.environ['KRONOS_COORDINATOR_KEY']),
+                               int(os.environ.get('KRONOS_WORKER', 0)))
+else:
+    bot.shard_link = None
+
+startup.mark('setup')
 
 
 @bot.event
 async def on_ready():
     await bot.change_presence(status = discord.Status.idle, activity = discord.Game("Listening to .help"))
-    print("Kronos is ready")
+
+    if not startup.ready:
+        startup.mark('ready')
+        print("Kronos is ready in {:.2f}s ({})".format(startup.total(), startup.report()))
+
+        if os.environ.get('KRONOS_PREWARM_EXTRACTOR', '1') == '1':
+            # Pay for importing youtube_dl now instead of on the first play.
+            bot.loop.run_in_executor(None, YTDLSource.extractor)
+    else:
+        print("Kronos is ready")
+
+@bot.event
+async def on_connect():
+    # Report as soon as the first shard is up; with many shards per worker
+    # on_ready can take minutes and the launcher would think we're stuck.
+    startup.mark('connect')
+    metrics.start(bot.loop)
+    if bot.shard_link is not None:
+        bot.shard_link.start()
     
 @bot.command(name="whoami")
 async def whoami(ctx) :
@@ -571,5 +4097,6 @@ async def tellmeafact(ctx) :
         await ctx.send("Çitalar kükreyemez")
     sayi=0
     
-bot.run('Token')
+if __name__ == '__main__':
+    bot.run(os.environ.get('KRONOS_TOKEN', 'Token'))
 #Bu satıra discorddan alacağınız Token gelecektir
\ No newline at end of file